@@ -1,15 +1,29 @@
+import argparse
 import functools
+import hashlib
 import inspect
+import itertools
+import json
+import math
+import os
+import pickle
+import shutil
+import signal
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import warnings
 
 import decorator
 import greenlet
 import pytest
 
-from twisted.internet import error, defer
+from twisted.internet import error, defer, protocol, task
 from twisted.internet.threads import blockingCallFromThread
-from twisted.python import failure
+from twisted.python import failure, log
 
 
 class WrongReactorAlreadyInstalledError(Exception):
@@ -40,13 +54,82 @@ class AsyncFixtureUnsupportedScopeError(Exception):
         )
 
 
+class AsyncFixtureCacheUnsupportedError(Exception):
+    @classmethod
+    def from_mark(cls, mark):
+        return cls(
+            'cache= is not supported for {}'.format(mark)
+        )
+
+
 class _config:
     external_reactor = False
+    benchmark_json = None
+    benchmark_max_time = 1.0
+    benchmark_min_rounds = 5
+    engine = 'greenlet'
+    threadpool_min = None
+    threadpool_max = None
+    threadpool_join_timeout = None
+    shutdown_timeout = None
+    shutdown_slow = 1.0
+    trial = False
+    trial_dirty_reactor = False
+    fork = False
+    fork_chunk = 0
+    reactors = ()
+    worker_fd = None
+    worker_nodeids = None
+    process_pool_size = None
+    asyncio_loop = None
+    abort_timeout = 2.0
+    greenlet_per_test = False
+    io_stats = False
+    longest_first = False
+    weights = None
+    durations_decay = 0.5
+    durations_max_age = 10
 
 
 class _instances:
     gr_twisted = None
     reactor = None
+    step_engine = False
+    in_step = False
+    threadpool_monitor = None
+    io_monitor = None
+    io_results = []
+    shutdown_manager = None
+    worker_findings = []
+    worker_stream = None
+    worker_config = None
+    tracer = None
+    benchmarks = []
+    load_results = []
+    durations = {}
+    fixture_cache = None
+    async_sources = {}
+    process_pool = None
+    session = None
+    waiting = None
+    interrupted = False
+
+
+_clock = getattr(time, 'monotonic', time.time)
+_timer = getattr(time, 'perf_counter', _clock)
+_cpu_timer = getattr(time, 'process_time', None) or time.clock
+
+
+def _describe(f):
+    name = getattr(f, '__qualname__', None) or getattr(f, '__name__', None)
+    if name is None:
+        return repr(f)
+
+    module = getattr(f, '__module__', None)
+    if module is None:
+        return name
+
+    return '{}.{}'.format(module, name)
 
 
 def _deprecate(deprecated, recommended):
@@ -69,9 +152,15 @@ def _deprecate(deprecated, recommended):
 
 
 def blockon(d):
+    if isinstance(greenlet.getcurrent(), _ReactorGreenlet):
+        return _wait_in_greenlet(d)
+
     if _config.external_reactor:
         return block_from_thread(d)
 
+    if _instances.step_engine:
+        return blockon_step(d)
+
     return blockon_default(d)
 
 
@@ -84,13 +173,64 @@ def blockon_default(d):
 
     def cb(r):
         result.append(r)
-        if greenlet.getcurrent() is not current:
+        caller = greenlet.getcurrent()
+        if isinstance(caller, _ReactorGreenlet):
+            # switching away would leave the rest of that greenlet, and of
+            # the callback chain it runs, suspended for good
+            _instances.reactor.callFromThread(current.switch, result)
+        elif caller is not current:
             current.switch(result)
 
     d.addCallbacks(cb, cb)
     if not result:
-        _result = _instances.gr_twisted.switch()
+        started = _clock()
+        waiting = _instances.waiting = _Waiting(d, result, wake=cb)
+        try:
+            _result = _instances.gr_twisted.switch()
+        finally:
+            _instances.waiting = None
         assert _result is result, "illegal switch in blockon"
+        _trace('blockon', 'blockon', started)
+
+        if waiting.interrupted:
+            raise KeyboardInterrupt
+
+    if isinstance(result[0], failure.Failure):
+        result[0].raiseException()
+
+    return result[0]
+
+
+def blockon_step(d):
+    assert (
+        not _instances.in_step
+    ), "blockon cannot be called from within the stepped reactor"
+    _start_step_engine()
+    result = []
+
+    def cb(r):
+        result.append(r)
+
+    def wake(r):
+        cb(r)
+        loop = getattr(_instances.reactor, '_asyncioEventloop', None)
+        if loop is not None:
+            loop.stop()
+
+    d.addCallbacks(cb, cb)
+    if not result:
+        started = _clock()
+        waiting = _instances.waiting = _Waiting(d, result, wake=wake)
+        _instances.in_step = True
+        try:
+            _step_reactor_until(d, result)
+        finally:
+            _instances.in_step = False
+            _instances.waiting = None
+        _trace('blockon', 'blockon', started)
+
+        if waiting.interrupted:
+            raise KeyboardInterrupt
 
     if isinstance(result[0], failure.Failure):
         result[0].raiseException()
@@ -98,6 +238,106 @@ def blockon_default(d):
     return result[0]
 
 
+class _Waiting(object):
+    # what blockon is waiting for, so that Ctrl-C can cancel it
+    def __init__(self, d, result, wake):
+        self.d = d
+        self.result = result
+        self.wake = wake
+        self.interrupted = False
+
+
+def _install_interrupt_handler():
+    # the reactor's own SIGINT handler only stops the reactor, leaving the
+    # test that was waiting on it stranded
+    try:
+        signal.signal(signal.SIGINT, _interrupt_handler)
+    except ValueError:
+        # not the main thread
+        pass
+
+
+def _interrupt_handler(signum, frame):
+    if _instances.shutdown_manager is not None:
+        # a KeyboardInterrupt raised here would only be logged by the
+        # reactor's main loop, cut the shutdown short instead
+        timeout = 0 if _instances.interrupted else _config.abort_timeout
+        _instances.interrupted = True
+        _instances.reactor.callFromThread(_abort_shutdown, timeout)
+        return
+
+    if _instances.waiting is None or _instances.interrupted:
+        # not waiting on the reactor, or pressed again
+        raise KeyboardInterrupt
+
+    _instances.interrupted = True
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    _instances.reactor.callFromThread(_interrupt)
+
+
+def _interrupt():
+    _cancel_delayed_calls()
+
+    waiting = _instances.waiting
+    if waiting is None:
+        return
+
+    waiting.interrupted = True
+    waiting.d.cancel()
+    if not waiting.result:
+        waiting.wake(failure.Failure(KeyboardInterrupt()))
+
+
+def _abort_shutdown(timeout):
+    _cancel_delayed_calls()
+    _instances.shutdown_manager.abort(timeout)
+
+
+def _restore_interrupt_handler():
+    try:
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+    except ValueError:
+        # not the main thread
+        pass
+
+
+def _cancel_delayed_calls():
+    for call in _instances.reactor.getDelayedCalls():
+        if call.active():
+            call.cancel()
+
+
+def _aborting():
+    session = _instances.session
+    return _instances.interrupted or bool(
+        session is not None and (session.shouldfail or session.shouldstop)
+    )
+
+
+def _start_step_engine():
+    reactor = _instances.reactor
+    if not reactor._started and not reactor._startedBefore:
+        reactor.startRunning()
+
+
+def _step_reactor_until(d, result):
+    reactor = _instances.reactor
+    loop = getattr(reactor, '_asyncioEventloop', None)
+
+    if loop is not None:
+        # the asyncio loop owns the iteration, let it run until d fires
+        d.addBoth(lambda _: loop.stop())
+        while not result:
+            loop.run_forever()
+        return
+
+    while not result:
+        reactor.runUntilCurrent()
+        if result:
+            break
+        reactor.doIteration(reactor.timeout())
+
+
 def block_from_thread(d):
     return blockingCallFromThread(_instances.reactor, lambda x: x, d)
 
@@ -113,11 +353,20 @@ def ensureDeferred(fun, *args, **kw):
 
 
 def init_twisted_greenlet():
-    if _instances.reactor is None or _instances.gr_twisted:
+    if (
+        _instances.reactor is None
+        or _instances.gr_twisted
+        or _instances.step_engine
+    ):
         return
 
     if not _instances.reactor.running:
-        _instances.gr_twisted = greenlet.greenlet(_instances.reactor.run)
+        if _config.engine == 'step':
+            # started on first use, see _start_step_engine()
+            _instances.step_engine = True
+        else:
+            _instances.gr_twisted = greenlet.greenlet(_instances.reactor.run)
+        _instances.reactor.callWhenRunning(_install_interrupt_handler)
         # give me better tracebacks:
         failure.Failure.cleanFailure = lambda self: None
     else:
@@ -126,14 +375,730 @@ def init_twisted_greenlet():
 
 def stop_twisted_greenlet():
     if _instances.gr_twisted:
-        _instances.reactor.stop()
+        _start_shutdown()
         _instances.gr_twisted.switch()
+        _restore_interrupt_handler()
+    elif _instances.step_engine and _instances.reactor._started:
+        stopped = defer.Deferred()
+        _instances.reactor.addSystemEventTrigger(
+            'after', 'shutdown', stopped.callback, None,
+        )
+        _start_shutdown()
+        blockon_step(stopped)
+        _restore_interrupt_handler()
+
+
+def _start_shutdown():
+    timeout = _config.shutdown_timeout
+    if _aborting():
+        # the session is ending early, don't wait on work nobody needs
+        _cancel_delayed_calls()
+        if timeout is None or timeout > _config.abort_timeout:
+            timeout = _config.abort_timeout
+
+    _instances.shutdown_manager = _ShutdownManager(
+        reactor=_instances.reactor,
+        timeout=timeout,
+        slow=_config.shutdown_slow,
+    )
+    # Ctrl-C may have restored the default handler while a test waited
+    _install_interrupt_handler()
+    _instances.reactor.callLater(0, _instances.shutdown_manager.start)
+
+
+def _trace(name, cat, started, **args):
+    if _instances.tracer is not None:
+        _instances.tracer.complete(name, cat, started, **args)
+
+
+class _TracedCall(object):
+    def __init__(self, tracer, f):
+        self.tracer = tracer
+        self.f = f
+
+    def __call__(self, *args, **kwargs):
+        started = _clock()
+        try:
+            return self.f(*args, **kwargs)
+        finally:
+            self.tracer.complete(_describe(self.f), 'delayed-call', started)
+
+    def __repr__(self):
+        return repr(self.f)
+
+
+class _TraceRecorder(object):
+    """Buffer reactor timeline events for a Chrome trace event file.
+
+    Events are kept as plain tuples while the session runs and converted to
+    the trace event format, loadable in Perfetto or chrome://tracing, only
+    when written out.
+    """
+
+    main_tid = 1
+    twisted_tid = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+        self.merged = []
+        self.start = _clock()
+        self._twisted_since = None
+        self._previous_trace = None
+
+    def install(self, reactor):
+        settrace = getattr(greenlet, 'settrace', None)
+        if settrace is not None:
+            self._previous_trace = settrace(self._trace_greenlet)
+
+        call_later = reactor.callLater
+
+        def traced_call_later(delay, f, *args, **kwargs):
+            return call_later(delay, _TracedCall(self, f), *args, **kwargs)
+
+        reactor.callLater = traced_call_later
+
+    def _tid(self):
+        current = greenlet.getcurrent()
+        if current is _instances.gr_twisted:
+            return self.twisted_tid
+
+        return self.main_tid
+
+    def complete(self, name, cat, started, finished=None, tid=None, **args):
+        if finished is None:
+            finished = _clock()
+        if tid is None:
+            tid = self._tid()
+        self.events.append((name, cat, started, finished, tid, args))
+
+    def _trace_greenlet(self, event, args):
+        if event in ('switch', 'throw'):
+            origin, target = args
+            twisted = _instances.gr_twisted
+            if twisted is not None and target is twisted:
+                self._twisted_since = _clock()
+            elif (
+                twisted is not None
+                and origin is twisted
+                and self._twisted_since is not None
+            ):
+                self.complete(
+                    'twisted greenlet',
+                    'greenlet',
+                    self._twisted_since,
+                    tid=self.twisted_tid,
+                )
+                self._twisted_since = None
+
+        if self._previous_trace is not None:
+            return self._previous_trace(event, args)
+
+    def _to_microseconds(self, t):
+        return (t - self.start) * 1e6
+
+    def fork_child(self):
+        # a forked child records only its own events, into a part file
+        self.events = []
+        self.merged = []
+        self.path = _trace_part_path(self.path, os.getpid())
+
+    def merge(self, pid):
+        """Add the events of the worker or child ``pid`` from its part file."""
+        path = _trace_part_path(self.path, pid)
+        try:
+            with open(path) as f:
+                part = json.load(f)
+        except (IOError, OSError, ValueError):
+            # the process died before writing its events
+            return
+        os.remove(path)
+
+        start = part.get('otherData', {}).get('start', self.start)
+        shift = (start - self.start) * 1e6
+        for event in part['traceEvents']:
+            if 'ts' in event:
+                event['ts'] += shift
+            self.merged.append(event)
+
+    def write(self):
+        pid = os.getpid()
+        trace_events = [
+            {
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': pid,
+                'tid': tid,
+                'args': {'name': name},
+            }
+            for tid, name in (
+                (self.main_tid, 'main greenlet'),
+                (self.twisted_tid, 'twisted greenlet'),
+            )
+        ]
+        for name, cat, started, finished, tid, args in self.events:
+            trace_events.append({
+                'name': name,
+                'cat': cat,
+                'ph': 'X',
+                'ts': self._to_microseconds(started),
+                'dur': (finished - started) * 1e6,
+                'pid': pid,
+                'tid': tid,
+                'args': args,
+            })
+        trace_events.extend(self.merged)
+
+        with open(self.path, 'w') as f:
+            json.dump(
+                {
+                    'traceEvents': trace_events,
+                    'displayTimeUnit': 'ms',
+                    'otherData': {'start': self.start},
+                },
+                f,
+            )
+
+
+def _trace_part_path(path, pid):
+    return '{}.{}'.format(path, pid)
+
+
+def _configure_trace(config):
+    path = config.getoption('twisted_trace')
+    if path is None or _instances.reactor is None:
+        return
+
+    if _config.worker_fd is not None:
+        # the parent merges the events of its reactor workers
+        path = _trace_part_path(path, os.getpid())
+
+    _instances.tracer = _TraceRecorder(path=path)
+    _instances.tracer.install(_instances.reactor)
+
+
+def _daemon_thread_factory(*args, **kwargs):
+    thread = threading.Thread(*args, **kwargs)
+    thread.daemon = True
+    return thread
+
+
+class _ThreadPoolMonitor(object):
+    """Instrument and manage the shutdown of the reactor thread pool.
+
+    Every call submitted to the pool is timed from submission until a worker
+    picks it up so that queue depth and wait time can be reported per test.
+    The reactor's own shutdown trigger, which joins the workers without a
+    deadline, is replaced by :meth:`stop`.
+    """
+
+    def __init__(self, reactor, pool):
+        self.reactor = reactor
+        self.pool = pool
+        self.stuck = []
+        self.session_max_queue_depth = 0
+        self.session_max_wait = 0.0
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._active = {}
+        self.reset()
+
+        self._original_call = pool.callInThreadWithCallback
+        pool.callInThreadWithCallback = self.callInThreadWithCallback
+        # stuck workers must not keep the interpreter alive after the deadline
+        pool.threadFactory = _daemon_thread_factory
+
+        if reactor.threadpoolShutdownID is not None:
+            reactor.removeSystemEventTrigger(reactor.threadpoolShutdownID)
+        reactor.threadpoolShutdownID = reactor.addSystemEventTrigger(
+            'during', 'shutdown', self.stop,
+        )
+
+    def reset(self):
+        with self._lock:
+            self.submitted = 0
+            self.max_queue_depth = self._pending
+            self.max_wait = 0.0
+            self.total_wait = 0.0
+
+    def callInThreadWithCallback(self, onResult, func, *args, **kw):
+        submitted = _clock()
+        with self._lock:
+            self._pending += 1
+            self.submitted += 1
+            self.max_queue_depth = max(self.max_queue_depth, self._pending)
+            self.session_max_queue_depth = max(
+                self.session_max_queue_depth, self._pending,
+            )
+
+        def timed(*args, **kw):
+            started = _clock()
+            wait = started - submitted
+            ident = threading.current_thread().ident
+            with self._lock:
+                self._pending -= 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.session_max_wait = max(self.session_max_wait, wait)
+                self._active[ident] = (_describe(func), started)
+            try:
+                return func(*args, **kw)
+            finally:
+                with self._lock:
+                    self._active.pop(ident, None)
+
+        return self._original_call(onResult, timed, *args, **kw)
+
+    def user_properties(self):
+        with self._lock:
+            return [
+                ('twisted_threadpool_calls', self.submitted),
+                ('twisted_threadpool_max_queue_depth', self.max_queue_depth),
+                ('twisted_threadpool_max_wait', self.max_wait),
+                ('twisted_threadpool_total_wait', self.total_wait),
+            ]
+
+    def stop(self, timeout=None):
+        if timeout is None:
+            timeout = _config.threadpool_join_timeout
+        abort_timeout = _config.abort_timeout
+        if _aborting() and (timeout is None or timeout > abort_timeout):
+            timeout = abort_timeout
+
+        reactor = self.reactor
+        for trigger in (
+            reactor._threadpoolStartupID,
+            reactor.threadpoolShutdownID,
+        ):
+            if trigger is None:
+                continue
+            try:
+                reactor.removeSystemEventTrigger(trigger)
+            except ValueError:
+                pass
+        reactor._threadpoolStartupID = None
+        reactor.threadpoolShutdownID = None
+        reactor.threadpool = None
+
+        stopper = _daemon_thread_factory(
+            target=self.pool.stop,
+            name='pytest_twisted threadpool stopper',
+        )
+        stopper.start()
+        stopper.join(timeout)
+
+        if stopper.is_alive():
+            now = _clock()
+            with self._lock:
+                self.stuck = sorted(
+                    '{} (running for {:.3f}s)'.format(name, now - started)
+                    for name, started in self._active.values()
+                )
+
+        return self.stuck
+
+
+def _configure_threadpool(config):
+    _config.threadpool_min = config.getoption('twisted_threadpool_min')
+    _config.threadpool_max = config.getoption('twisted_threadpool_max')
+    _config.threadpool_join_timeout = config.getoption(
+        'twisted_threadpool_join_timeout',
+    )
+
+    managed = (
+        _config.threadpool_min is not None
+        or _config.threadpool_max is not None
+        or _config.threadpool_join_timeout is not None
+    )
+    if not managed or _config.external_reactor:
+        return
+
+    if _instances.threadpool_monitor is not None:
+        return
+
+    reactor = _instances.reactor
+    pool = reactor.getThreadPool()
+
+    minthreads = _config.threadpool_min
+    maxthreads = _config.threadpool_max
+    if minthreads is None:
+        minthreads = min(pool.min, maxthreads or pool.min)
+    if maxthreads is None:
+        maxthreads = max(pool.max, minthreads)
+    pool.adjustPoolsize(minthreads=minthreads, maxthreads=maxthreads)
+
+    _instances.threadpool_monitor = _ThreadPoolMonitor(
+        reactor=reactor,
+        pool=pool,
+    )
+
+
+class _IOMonitor(object):
+    """Count the socket I/O the reactor does on behalf of each test.
+
+    Connections are instrumented when they are first registered with
+    ``addReader()`` or ``addWriter()``.  Their ``doRead()`` and ``doWrite()``
+    calls and the bytes passed to and from the socket are counted against
+    the test running at the time.
+    """
+
+    fields = (
+        'connections',
+        'bytes_read',
+        'bytes_written',
+        'read_callbacks',
+        'write_callbacks',
+    )
+
+    def __init__(self, reactor):
+        from twisted.internet import tcp
+
+        self.reactor = reactor
+        self._connection_type = tcp.Connection
+        self._lock = threading.Lock()
+        self.reset()
+
+        add_reader = reactor.addReader
+        add_writer = reactor.addWriter
+
+        def addReader(reader):
+            self._instrument(reader)
+            return add_reader(reader)
+
+        def addWriter(writer):
+            self._instrument(writer)
+            return add_writer(writer)
+
+        reactor.addReader = addReader
+        reactor.addWriter = addWriter
+
+    def reset(self):
+        with self._lock:
+            self.counts = dict.fromkeys(self.fields, 0)
+
+    def count(self, field, n=1):
+        with self._lock:
+            self.counts[field] += n
+
+    def _instrument(self, selectable):
+        if not isinstance(selectable, self._connection_type):
+            return
+
+        if not getattr(selectable, '_pytest_twisted_io', False):
+            selectable._pytest_twisted_io = True
+            self.count('connections')
+
+        # clients replace doRead and doWrite while connecting and restore
+        # them afterwards, so each method is checked on every registration
+        for name, wrap in (
+            ('doRead', self._counting_calls('read_callbacks')),
+            ('doWrite', self._counting_calls('write_callbacks')),
+            ('_dataReceived', self._counting_data('bytes_read')),
+            ('writeSomeData', self._counting_written('bytes_written')),
+        ):
+            method = getattr(selectable, name)
+            if not getattr(method, '_pytest_twisted_io', False):
+                wrapper = wrap(method)
+                wrapper._pytest_twisted_io = True
+                setattr(selectable, name, wrapper)
+
+    def _counting_calls(self, field):
+        def wrap(method):
+            def wrapper():
+                self.count(field)
+                return method()
+
+            return wrapper
+
+        return wrap
+
+    def _counting_data(self, field):
+        def wrap(method):
+            def wrapper(data):
+                self.count(field, len(data))
+                return method(data)
+
+            return wrapper
+
+        return wrap
+
+    def _counting_written(self, field):
+        def wrap(method):
+            def wrapper(data):
+                result = method(data)
+                # an exception instance is returned if the connection is lost
+                if isinstance(result, int):
+                    self.count(field, result)
+                return result
+
+            return wrapper
+
+        return wrap
+
+    def user_properties(self):
+        with self._lock:
+            return [
+                ('twisted_io_' + field, self.counts[field])
+                for field in self.fields
+            ]
+
+
+def _configure_io_stats(config):
+    _config.io_stats = config.getoption('twisted_io_stats')
+    if (
+        not _config.io_stats
+        or _instances.reactor is None
+        or _instances.io_monitor is not None
+    ):
+        return
+
+    _instances.io_monitor = _IOMonitor(reactor=_instances.reactor)
+
+
+def _record_io(report):
+    if not _config.io_stats or report.when != 'teardown':
+        return
+
+    counts = dict(
+        (name[len('twisted_io_'):], value)
+        for name, value in report.user_properties
+        if name.startswith('twisted_io_')
+    )
+    if counts:
+        _instances.io_results.append((report.nodeid, counts))
+
+
+class _ShutdownManager(object):
+    """Run the reactor's before-shutdown triggers with an overall deadline.
+
+    The triggers are taken over from the reactor and started together.  Once
+    they have all finished, or the deadline passes, the reactor is stopped and
+    runs the remaining during and after phase triggers as usual.  Triggers
+    which have not finished by the deadline are abandoned and reported.
+    """
+
+    def __init__(self, reactor, timeout=None, slow=None):
+        self.reactor = reactor
+        self.timeout = timeout
+        self.slow = slow
+        self.durations = []
+        self.failed = []
+        self.stuck = []
+        self.timed_out = False
+        self.interrupted = False
+        self._pending = {}
+        self._deadline = None
+        self._expires = None
+        self._started = False
+        self._stopping = False
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+
+        event = self.reactor._eventTriggers.get('shutdown')
+        triggers = []
+        if event is not None:
+            triggers, event.before = event.before, []
+
+        deferreds = [
+            self._run(f, *args, **kwargs)
+            for f, args, kwargs in triggers
+        ]
+
+        if self.timeout is not None:
+            self._expire_in(self.timeout)
+
+        defer.DeferredList(deferreds).addCallback(self._stop)
+
+    def abort(self, timeout):
+        """Bring the deadline forward to at most ``timeout`` from now."""
+        if self._stopping:
+            return
+
+        self.interrupted = True
+        if not self._started:
+            # the delayed call starting the shutdown may have been cancelled
+            if self.timeout is None or self.timeout > timeout:
+                self.timeout = timeout
+            self.start()
+            return
+
+        if self._expires is not None:
+            remaining = self._expires - self.reactor.seconds()
+            timeout = max(0, min(timeout, remaining))
+        self._expire_in(timeout)
+
+    def _expire_in(self, timeout):
+        if self._deadline is not None and self._deadline.active():
+            self._deadline.cancel()
+        self._expires = self.reactor.seconds() + timeout
+        self._deadline = self.reactor.callLater(timeout, self._expire)
+
+    def _run(self, f, *args, **kwargs):
+        description = _describe(f)
+        started = _clock()
+        token = object()
+        self._pending[token] = description
+
+        def finished(result):
+            self._pending.pop(token, None)
+            self.durations.append((description, _clock() - started))
+            return result
+
+        def errored(reason):
+            self.failed.append(description)
+            log.err(reason, 'shutdown trigger {} failed'.format(description))
+
+        d = defer.maybeDeferred(f, *args, **kwargs)
+        d.addBoth(finished)
+        d.addErrback(errored)
+        return d
+
+    def _expire(self):
+        self._deadline = None
+        self.timed_out = True
+        self.stuck = sorted(self._pending.values())
+        self._stop(None)
+
+    def _stop(self, ignored):
+        if self._deadline is not None and self._deadline.active():
+            self._deadline.cancel()
+        self._deadline = None
+
+        if not self._stopping:
+            self._stopping = True
+            self.reactor.stop()
+
+    def slow_triggers(self):
+        if self.slow is None:
+            return []
+
+        return sorted(
+            (
+                (description, duration)
+                for description, duration in self.durations
+                if duration >= self.slow
+            ),
+            key=lambda item: item[1],
+            reverse=True,
+        )
+
+
+def _configure_shutdown(config):
+    _config.shutdown_timeout = config.getoption('twisted_shutdown_timeout')
+    _config.shutdown_slow = config.getoption('twisted_shutdown_slow')
+    _config.abort_timeout = config.getoption('twisted_abort_timeout')
 
 
 class _CoroutineWrapper:
-    def __init__(self, coroutine, mark):
+    def __init__(self, coroutine, mark, on_result=None):
         self.coroutine = coroutine
         self.mark = mark
+        self.on_result = on_result
+
+
+class _FixtureCache(object):
+    """Results of ``async_fixture(cache=...)`` fixtures kept on disk.
+
+    Entries are pickled, or with ``cache_mmap`` stored as raw bytes and
+    handed back as a read-only memory map.  They are named by a hash of
+    the cache key, the fixture name and the fixture source so that editing
+    the fixture invalidates them.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @classmethod
+    def from_config(cls, config):
+        cache = getattr(config, 'cache', None)
+        if cache is None:
+            return None
+
+        mkdir = getattr(cache, 'mkdir', None) or cache.makedir
+        return cls(directory=str(mkdir('pytest_twisted_fixtures')))
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory)
+
+    def path(self, f, key, mmap):
+        try:
+            source = inspect.getsource(f).encode('utf-8')
+        except (IOError, TypeError):
+            source = f.__code__.co_code
+
+        digest = hashlib.sha256()
+        for part in (repr(key).encode('utf-8'), _describe(f).encode('utf-8')):
+            digest.update(part)
+            digest.update(b'\0')
+        digest.update(source)
+
+        return os.path.join(
+            self.directory,
+            digest.hexdigest() + ('.bin' if mmap else '.pickle'),
+        )
+
+    def _open_mmap(self, path):
+        import mmap
+
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def load(self, path, max_age):
+        try:
+            modified = os.path.getmtime(path)
+        except OSError:
+            return False, None
+
+        if max_age is not None and time.time() - modified > max_age:
+            return False, None
+
+        if path.endswith('.bin'):
+            return True, self._open_mmap(path)
+
+        try:
+            with open(path, 'rb') as f:
+                return True, pickle.load(f)
+        except Exception:
+            # unreadable entries, e.g. from another Python, are recomputed
+            return False, None
+
+    def store(self, path, value):
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary, 'wb') as f:
+            if path.endswith('.bin'):
+                f.write(value)
+            else:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        getattr(os, 'replace', os.rename)(temporary, path)
+
+        if path.endswith('.bin'):
+            return self._open_mmap(path)
+
+        return value
+
+
+def _cached_fixture_call(f, mark, cache, max_age, mmap, args, kwargs):
+    fixture_cache = _instances.fixture_cache
+    if fixture_cache is None:
+        return _CoroutineWrapper(coroutine=f(*args, **kwargs), mark=mark)
+
+    key = cache(**kwargs) if callable(cache) else cache
+    path = fixture_cache.path(f, key, mmap)
+    hit, value = fixture_cache.load(path, max_age)
+    if hit:
+        return value
+
+    return _CoroutineWrapper(
+        coroutine=f(*args, **kwargs),
+        mark=mark,
+        on_result=functools.partial(fixture_cache.store, path),
+    )
 
 
 def _marked_async_fixture(mark):
@@ -147,9 +1112,28 @@ def _marked_async_fixture(mark):
         if scope != 'function':
             raise AsyncFixtureUnsupportedScopeError.from_scope(scope=scope)
 
+        cache = kwargs.pop('cache', None)
+        cache_max_age = kwargs.pop('cache_max_age', None)
+        cache_mmap = kwargs.pop('cache_mmap', False)
+        # False turns the cache off just like None, it is not a key
+        cached = cache is not None and cache is not False
+        if cached and mark != 'async_fixture':
+            raise AsyncFixtureCacheUnsupportedError.from_mark(mark=mark)
+
         def marker(f):
             @functools.wraps(f)
             def w(*args, **kwargs):
+                if cached:
+                    return _cached_fixture_call(
+                        f=f,
+                        mark=mark,
+                        cache=cache,
+                        max_age=cache_max_age,
+                        mmap=cache_mmap,
+                        args=args,
+                        kwargs=kwargs,
+                    )
+
                 return _CoroutineWrapper(
                     coroutine=f(*args, **kwargs),
                     mark=mark,
@@ -181,11 +1165,14 @@ def _pytest_pyfunc_call(pyfuncitem):
         for arg in pyfuncitem._fixtureinfo.argnames:
             if isinstance(funcargs[arg], _CoroutineWrapper):
                 wrapper = funcargs[arg]
+                started = _clock()
 
                 if wrapper.mark == 'async_fixture':
                     arg_value = yield defer.ensureDeferred(
                         wrapper.coroutine
                     )
+                    if wrapper.on_result is not None:
+                        arg_value = wrapper.on_result(arg_value)
                 elif wrapper.mark == 'async_yield_fixture':
                     async_generators.append((arg, wrapper))
                     arg_value = yield defer.ensureDeferred(
@@ -195,13 +1182,25 @@ def _pytest_pyfunc_call(pyfuncitem):
                     raise UnrecognizedCoroutineMarkError.from_mark(
                         mark=wrapper.mark,
                     )
+                _trace('async fixture {}'.format(arg), 'fixture', started)
             else:
                 arg_value = funcargs[arg]
 
             testargs[arg] = arg_value
     else:
         testargs = funcargs
-    result = yield testfunction(**testargs)
+
+    hypothesis = getattr(testfunction, 'hypothesis', None)
+    if getattr(hypothesis, 'inner_test', None) is not None:
+        if not getattr(hypothesis.inner_test, 'waits_in_greenlet', False):
+            hypothesis.inner_test = _hypothesis_inner_test(
+                hypothesis.inner_test,
+            )
+        result = yield _run_in_greenlet(testfunction, **testargs)
+    elif _config.greenlet_per_test:
+        result = yield _run_in_greenlet(testfunction, **testargs)
+    else:
+        result = yield testfunction(**testargs)
 
     async_generator_deferreds = [
         (arg, defer.ensureDeferred(g.coroutine.__anext__()))
@@ -221,26 +1220,170 @@ def _pytest_pyfunc_call(pyfuncitem):
     defer.returnValue(result)
 
 
+class _ReactorGreenlet(greenlet.greenlet):
+    """A greenlet started from the greenlet driving the reactor.
+
+    Code running in it can wait on a Deferred with ``blockon()``, which
+    switches back to the reactor until the Deferred fires.
+    """
+
+
+def _run_in_greenlet(f, *args, **kwargs):
+    # Returns the result of f if it finished without waiting, otherwise a
+    # Deferred firing with it.  Inside a reactor greenlet f is just called
+    # since it can wait there already.
+    if isinstance(greenlet.getcurrent(), _ReactorGreenlet):
+        return f(*args, **kwargs)
+
+    outcome = []
+    done = []
+
+    def run():
+        try:
+            result = f(*args, **kwargs)
+        except greenlet.GreenletExit:
+            raise
+        except BaseException:
+            # pytest.skip(), pytest.fail() and pytest.xfail() raise
+            # BaseException subclasses which must reach the test as well
+            result = failure.Failure()
+
+        if done:
+            # fire from the reactor rather than this greenlet, which is
+            # about to end
+            _instances.reactor.callFromThread(fire, result)
+        else:
+            outcome.append(result)
+
+    def fire(result):
+        if isinstance(result, defer.Deferred):
+            result.chainDeferred(done[0])
+        else:
+            done[0].callback(result)
+
+    _ReactorGreenlet(run).switch()
+
+    if not outcome:
+        done.append(defer.Deferred())
+        return done[0]
+
+    if isinstance(outcome[0], failure.Failure):
+        outcome[0].raiseException()
+
+    return outcome[0]
+
+
+def in_greenlet(f):
+    """Run each call of ``f`` in a greenlet of its own.
+
+    ``blockon()`` can then be used in ``f`` even when it is called by the
+    reactor, e.g. as a protocol method or a Deferred callback.  A call
+    which has to wait returns a Deferred firing with the result.
+    """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        return _run_in_greenlet(f, *args, **kwargs)
+
+    return wrapper
+
+
+def _wait_in_greenlet(d):
+    current = greenlet.getcurrent()
+    result = []
+
+    def cb(r):
+        result.append(r)
+        caller = greenlet.getcurrent()
+        if caller is current.parent:
+            current.switch()
+        elif caller is not current:
+            # fired by another reactor greenlet, which must not be left
+            # suspended, so resume from the reactor instead
+            _instances.reactor.callFromThread(current.switch)
+
+    d.addBoth(cb)
+    if not result:
+        current.parent.switch()
+
+    if isinstance(result[0], failure.Failure):
+        result[0].raiseException()
+
+    return result[0]
+
+
+def _hypothesis_inner_test(inner_test):
+    # Hypothesis calls inner_test once per example, including while
+    # shrinking, and expects it to return once the example has finished
+    @functools.wraps(inner_test)
+    def wrapper(*args, **kwargs):
+        return _wait_in_greenlet(_ensure_deferred(inner_test(*args, **kwargs)))
+
+    wrapper.waits_in_greenlet = True
+    return wrapper
+
+
 def pytest_pyfunc_call(pyfuncitem):
+    started = _timer()
+    try:
+        _run_pyfunc_call(pyfuncitem)
+    finally:
+        pyfuncitem._twisted_reactor_time = _timer() - started
+    return True
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    outcome = yield
+    if call.when == 'call':
+        # carried along when reports are serialized from fork children and
+        # reactor workers
+        report = outcome.get_result()
+        report.twisted_reactor_time = getattr(
+            item, '_twisted_reactor_time', 0.0,
+        )
+        benchmark = getattr(item, '_twisted_benchmark', None)
+        if benchmark is not None and benchmark.stats is not None:
+            report.twisted_benchmark = benchmark.as_dict()
+        load = getattr(item, '_twisted_load', None)
+        if load is not None and load.results:
+            report.twisted_load = load.results
+
+
+def _run_pyfunc_call(pyfuncitem):
     if _instances.gr_twisted is not None:
         if _instances.gr_twisted.dead:
             raise RuntimeError("twisted reactor has stopped")
 
         def in_reactor(d, f, *args):
-            return defer.maybeDeferred(f, *args).chainDeferred(d)
-
-        d = defer.Deferred()
+            _trace('callLater hop', 'reactor', scheduled)
+            inner = defer.maybeDeferred(f, *args)
+            started.append(inner)
+            # d may already have been cancelled by Ctrl-C
+            inner.addBoth(lambda result: d.called or d.callback(result))
+
+        def cancel(d):
+            for inner in started:
+                inner.cancel()
+
+        started = []
+        d = defer.Deferred(canceller=cancel)
+        scheduled = _clock()
         _instances.reactor.callLater(
             0.0, in_reactor, d, _pytest_pyfunc_call, pyfuncitem
         )
         blockon_default(d)
+    elif _instances.step_engine:
+        _start_step_engine()
+        if not _instances.reactor._started:
+            raise RuntimeError("twisted reactor has stopped")
+
+        blockon_step(_pytest_pyfunc_call(pyfuncitem))
     else:
         if not _instances.reactor.running:
             raise RuntimeError("twisted reactor is not running")
         blockingCallFromThread(
             _instances.reactor, _pytest_pyfunc_call, pyfuncitem
         )
-    return True
 
 
 @pytest.fixture(scope="session", autouse=True)
@@ -249,71 +1392,2123 @@ def twisted_greenlet(request):
     return _instances.gr_twisted
 
 
-def init_default_reactor():
-    import twisted.internet.default
+def _from_parent(cls, parent, **kwargs):
+    from_parent = getattr(cls, 'from_parent', None)
+    if from_parent is None:
+        return cls(parent=parent, **kwargs)
 
-    module = inspect.getmodule(twisted.internet.default.install)
+    return from_parent(parent, **kwargs)
 
-    module_name = module.__name__.split(".")[-1]
-    reactor_type_name, = (x for x in dir(module) if x.lower() == module_name)
-    reactor_type = getattr(module, reactor_type_name)
 
-    _install_reactor(
-        reactor_installer=twisted.internet.default.install,
-        reactor_type=reactor_type,
-    )
+class _TrialTestCase(pytest.Class):
+    def collect(self):
+        from twisted.python import reflect
 
+        names = reflect.prefixedMethodNames(self.obj, 'test')
+        for name in sorted('test' + name for name in names):
+            yield _from_parent(
+                _TrialTestCaseFunction,
+                self,
+                name=name,
+                callobj=_trial_test_function(self.obj, name),
+            )
 
-def init_qt5_reactor():
-    import qt5reactor
 
-    _install_reactor(
-        reactor_installer=qt5reactor.install, reactor_type=qt5reactor.QtReactor
-    )
+class _TrialTestCaseFunction(pytest.Function):
+    # trial test methods take no arguments, fixtures only come from
+    # autouse and usefixtures
+    nofuncargs = True
 
 
-def init_asyncio_reactor():
-    from twisted.internet import asyncioreactor
+def _trial_test_function(cls, name):
+    method = getattr(cls, name)
 
-    _install_reactor(
-        reactor_installer=asyncioreactor.install,
-        reactor_type=asyncioreactor.AsyncioSelectorReactor,
-    )
+    @functools.wraps(method)
+    def run():
+        return _run_trial_test(cls(name))
 
+    return run
 
-reactor_installers = {
-    "default": init_default_reactor,
-    "qt5reactor": init_qt5_reactor,
-    "asyncio": init_asyncio_reactor,
-}
 
+def _call_trial_method(testcase, f, *args, **kwargs):
+    d = defer.maybeDeferred(f, *args, **kwargs)
+    get_timeout = getattr(testcase, 'getTimeout', None)
+    if get_timeout is not None:
+        d.addTimeout(get_timeout(), _instances.reactor)
 
-def _install_reactor(reactor_installer, reactor_type):
-    try:
-        reactor_installer()
-    except error.ReactorAlreadyInstalledError:
-        import twisted.internet.reactor
+    return d
 
-        if not isinstance(twisted.internet.reactor, reactor_type):
-            raise WrongReactorAlreadyInstalledError(
-                "expected {} but found {}".format(
-                    reactor_type, type(twisted.internet.reactor)
-                )
-            )
 
-    import twisted.internet.reactor
+@defer.inlineCallbacks
+def _run_trial_test(testcase):
+    skip = testcase.getSkip()
+    if isinstance(skip, tuple):
+        # Twisted 21.2 and later return (skip, reason)
+        skip, reason = skip
+    else:
+        skip, reason = skip is not None, skip
+    if skip:
+        pytest.skip(str(reason))
+
+    reactor = _instances.reactor
+    delayed_calls = set(reactor.getDelayedCalls())
+    selectables = set(reactor.getReaders() + reactor.getWriters())
+    failures = []
+    test_failure = None
+    passed = False
+
+    # errors logged while the test runs fail it unless flushLoggedErrors()
+    # removes them, as under trial
+    testcase._installObserver()
+    try:
+        # setUp, test, cleanups and then tearDown, as trial orders them
+        try:
+            yield _call_trial_method(testcase, testcase.setUp)
+        except BaseException:
+            failures.append(failure.Failure())
+            set_up = False
+        else:
+            set_up = True
+            try:
+                yield _call_trial_method(
+                    testcase, getattr(testcase, testcase._testMethodName),
+                )
+            except BaseException:
+                test_failure = failure.Failure()
+                failures.append(test_failure)
+            else:
+                passed = True
+
+        while testcase._cleanups:
+            f, args, kwargs = testcase._cleanups.pop()
+            try:
+                yield _call_trial_method(testcase, f, *args, **kwargs)
+            except BaseException:
+                failures.append(failure.Failure())
+
+        if set_up:
+            try:
+                yield _call_trial_method(testcase, testcase.tearDown)
+            except BaseException:
+                failures.append(failure.Failure())
+
+        if _config.trial_dirty_reactor:
+            # let calls scheduled for right now run, as trial's janitor does
+            yield task.deferLater(reactor, 0, lambda: None)
+            try:
+                _check_dirty_reactor(reactor, delayed_calls, selectables)
+            except BaseException:
+                failures.append(failure.Failure())
+
+        failures.extend(testcase._observer.getErrors())
+    finally:
+        testcase._observer.flushErrors()
+        testcase._removeObserver()
+
+    todo = testcase.getTodo()
+    if failures:
+        # only a failure of the test method itself can be expected
+        if (
+            todo is not None
+            and failures[0] is test_failure
+            and todo.expected(test_failure)
+        ):
+            pytest.xfail(todo.reason)
+
+        failures[0].raiseException()
+
+    if todo is not None and passed:
+        pytest.fail(
+            'unexpected success, todo: {}'.format(todo.reason),
+            pytrace=False,
+        )
 
-    _instances.reactor = twisted.internet.reactor
-    init_twisted_greenlet()
 
+def _check_dirty_reactor(reactor, delayed_calls, selectables):
+    from twisted.internet import interfaces
+    from twisted.trial.util import DirtyReactorAggregateError
 
-def pytest_addoption(parser):
-    group = parser.getgroup("twisted")
-    group.addoption(
-        "--reactor",
-        default="default",
-        choices=tuple(reactor_installers.keys()),
-    )
+    dirty_calls = []
+    for call in reactor.getDelayedCalls():
+        if call in delayed_calls or not call.active():
+            continue
+        dirty_calls.append(str(call))
+        call.cancel()
+
+    dirty_selectables = []
+    for selectable in reactor.getReaders() + reactor.getWriters():
+        if selectable in selectables:
+            continue
+        if repr(selectable) in dirty_selectables:
+            continue
+        reactor.removeReader(selectable)
+        reactor.removeWriter(selectable)
+        if interfaces.IProcessTransport.providedBy(selectable):
+            selectable.signalProcess('KILL')
+        dirty_selectables.append(repr(selectable))
+
+    if dirty_calls or dirty_selectables:
+        raise DirtyReactorAggregateError(dirty_calls, dirty_selectables)
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pycollect_makeitem(collector, name, obj):
+    if not _config.trial or not inspect.isclass(obj):
+        return None
+
+    from twisted.trial import unittest
+
+    if not issubclass(obj, unittest.SynchronousTestCase):
+        return None
+
+    return _from_parent(_TrialTestCase, collector, name=name, obj=obj)
+
+
+def _configure_trial(config):
+    _config.trial = config.getoption('twisted_trial')
+    _config.trial_dirty_reactor = config.getoption(
+        'twisted_trial_dirty_reactor',
+    )
+
+
+class _TwistedBenchmark(object):
+    """Time a Deferred or coroutine returning callable on the reactor.
+
+    Calling the benchmark returns a Deferred so all rounds run on the reactor
+    without switching back to the test between them.  Each round waits for
+    the result before the next one starts.
+    """
+
+    min_time = 0.000005
+    max_iterations = 1000000
+
+    def __init__(self, name, fullname, params, param, max_time, min_rounds):
+        self.name = name
+        self.fullname = fullname
+        self.params = params
+        self.param = param
+        self.max_time = max_time
+        self.min_rounds = min_rounds
+        self.extra_info = {}
+        self.stats = None
+        self.cpu_stats = None
+        self.iterations = None
+
+    def __call__(self, f, *args, **kwargs):
+        return self._run(
+            f, args, kwargs, rounds=None, iterations=None, warmup_rounds=1,
+        )
+
+    def pedantic(
+            self,
+            target,
+            args=(),
+            kwargs=None,
+            rounds=1,
+            iterations=1,
+            warmup_rounds=0,
+    ):
+        return self._run(
+            target,
+            args,
+            kwargs or {},
+            rounds=rounds,
+            iterations=iterations,
+            warmup_rounds=warmup_rounds,
+        )
+
+    @defer.inlineCallbacks
+    def _round(self, f, args, kwargs, iterations):
+        started = _timer()
+        cpu_started = _cpu_timer()
+        for _ in range(iterations):
+            result = yield _ensure_deferred(f(*args, **kwargs))
+        wall = (_timer() - started) / iterations
+        cpu = (_cpu_timer() - cpu_started) / iterations
+
+        defer.returnValue((wall, cpu, result))
+
+    @defer.inlineCallbacks
+    def _run(self, f, args, kwargs, rounds, iterations, warmup_rounds):
+        if self.stats is not None:
+            raise RuntimeError('twisted_benchmark can only be used once')
+
+        for _ in range(warmup_rounds):
+            yield self._round(f, args, kwargs, iterations or 1)
+
+        if iterations is None:
+            iterations = 1
+            while iterations < self.max_iterations:
+                wall, _, _ = yield self._round(f, args, kwargs, iterations)
+                if wall * iterations >= self.min_time:
+                    break
+                iterations *= 10
+
+        walls = []
+        cpus = []
+        result = None
+        deadline = _timer() + self.max_time
+        while True:
+            wall, cpu, result = yield self._round(f, args, kwargs, iterations)
+            walls.append(wall)
+            cpus.append(cpu)
+
+            if rounds is not None:
+                if len(walls) >= rounds:
+                    break
+            elif len(walls) >= self.min_rounds and _timer() >= deadline:
+                break
+
+        self.iterations = iterations
+        self.stats = _benchmark_stats(walls, iterations)
+        self.cpu_stats = _benchmark_stats(cpus, iterations)
+
+        defer.returnValue(result)
+
+    def as_dict(self):
+        extra_info = dict(self.extra_info)
+        extra_info['cpu'] = {
+            key: self.cpu_stats[key]
+            for key in ('min', 'max', 'mean', 'median', 'stddev')
+        }
+
+        return {
+            'group': None,
+            'name': self.name,
+            'fullname': self.fullname,
+            'params': self.params,
+            'param': self.param,
+            'extra_info': extra_info,
+            'options': {
+                'disable_gc': False,
+                'timer': _timer.__name__,
+                'min_rounds': self.min_rounds,
+                'max_time': self.max_time,
+                'min_time': self.min_time,
+                'warmup': True,
+            },
+            'stats': self.stats,
+        }
+
+
+def _ensure_deferred(result):
+    if isinstance(result, defer.Deferred):
+        return result
+
+    if getattr(inspect, 'iscoroutine', lambda result: False)(result):
+        return defer.ensureDeferred(result)
+
+    return defer.succeed(result)
+
+
+def _quartiles(data):
+    def median(values):
+        middle, odd = divmod(len(values), 2)
+        if odd:
+            return values[middle]
+        return (values[middle - 1] + values[middle]) / 2.0
+
+    half = len(data) // 2
+    if len(data) < 2:
+        return data[0], median(data), data[0]
+
+    return median(data[:half]), median(data), median(data[-half:])
+
+
+def _benchmark_stats(data, iterations):
+    data = list(data)
+    ordered = sorted(data)
+    rounds = len(data)
+    total = sum(data)
+    mean = total / rounds
+    if rounds > 1:
+        stddev = (
+            sum((value - mean) ** 2 for value in data) / (rounds - 1)
+        ) ** 0.5
+    else:
+        stddev = 0.0
+    q1, median, q3 = _quartiles(ordered)
+    iqr = q3 - q1
+    low, high = q1 - 1.5 * iqr, q3 + 1.5 * iqr
+    inliers = [value for value in ordered if low <= value <= high]
+    iqr_outliers = rounds - len(inliers)
+    stddev_outliers = len([
+        value for value in data
+        if not mean - stddev <= value <= mean + stddev
+    ])
+
+    return {
+        'min': ordered[0],
+        'max': ordered[-1],
+        'mean': mean,
+        'stddev': stddev,
+        'rounds': rounds,
+        'median': median,
+        'iqr': iqr,
+        'q1': q1,
+        'q3': q3,
+        'iqr_outliers': iqr_outliers,
+        'stddev_outliers': stddev_outliers,
+        'outliers': '{};{}'.format(stddev_outliers, iqr_outliers),
+        'ld15iqr': inliers[0],
+        'hd15iqr': inliers[-1],
+        'ops': 1 / mean if mean else 0.0,
+        'total': total * iterations,
+        'iterations': iterations,
+        'data': data,
+    }
+
+
+@pytest.fixture
+def twisted_benchmark(request):
+    callspec = getattr(request.node, 'callspec', None)
+    benchmark = _TwistedBenchmark(
+        name=request.node.name,
+        fullname=request.node.nodeid,
+        params=None if callspec is None else {
+            key: repr(value) for key, value in callspec.params.items()
+        },
+        param=None if callspec is None else callspec.id,
+        max_time=_config.benchmark_max_time,
+        min_rounds=_config.benchmark_min_rounds,
+    )
+    # picked up with the call report, see _record_benchmark
+    request.node._twisted_benchmark = benchmark
+    return benchmark
+
+
+class _LatencyHistogram(object):
+    """Log-linear latency histogram in the style of HdrHistogram.
+
+    Values are kept in nanoseconds with ``sub_bucket_bits`` bits of
+    precision, so percentiles are accurate to within 1 / 2 **
+    sub_bucket_bits of the recorded value whatever its magnitude.
+    """
+
+    def __init__(self, sub_bucket_bits=7):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _shift(self, value):
+        return max(0, value.bit_length() - self.sub_bucket_bits - 1)
+
+    def record(self, seconds):
+        value = max(0, int(seconds * 1e9))
+        shift = self._shift(value)
+        bucket = (value >> shift) << shift
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+
+        rank = max(1, int(math.ceil(q / 100.0 * self.count)))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                # highest value equivalent to the bucket, as HdrHistogram
+                highest = bucket + (1 << self._shift(bucket)) - 1
+                return min(max(highest / 1e9, self.min), self.max)
+
+        return self.max
+
+
+class LoadStats(object):
+    """Results of a :func:`run_load` run, latencies are in seconds."""
+
+    def __init__(self, histogram, errors, failures, elapsed):
+        self.histogram = histogram
+        self.count = histogram.count
+        self.errors = errors
+        self.failures = failures
+        self.elapsed = elapsed
+        self.throughput = self.count / elapsed if elapsed else 0.0
+        self.min = histogram.min or 0.0
+        self.max = histogram.max or 0.0
+        self.mean = histogram.total / self.count if self.count else 0.0
+        self.p50 = histogram.percentile(50)
+        self.p90 = histogram.percentile(90)
+        self.p99 = histogram.percentile(99)
+        self.p999 = histogram.percentile(99.9)
+
+    def percentile(self, q):
+        return self.histogram.percentile(q)
+
+    def __repr__(self):
+        return (
+            '<LoadStats count={} errors={} throughput={:.1f}/s'
+            ' p50={:.6f}s p99={:.6f}s p999={:.6f}s>'.format(
+                self.count,
+                self.errors,
+                self.throughput,
+                self.p50,
+                self.p99,
+                self.p999,
+            )
+        )
+
+
+class _LoadRunner(object):
+    max_failures = 10
+
+    def __init__(self, f, concurrency, rate, duration, iterations, reactor):
+        self.f = f
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.iterations = iterations
+        self.reactor = reactor
+        self.histogram = _LatencyHistogram()
+        self.errors = 0
+        self.failures = []
+        self.launched = 0
+        self.in_flight = 0
+        self.backlog = []
+        self.ticking = False
+        self.draining = False
+        self.done = defer.Deferred()
+
+    def _can_start(self):
+        if self.iterations is not None and self.launched >= self.iterations:
+            return False
+
+        return self.deadline is None or _timer() < self.deadline
+
+    @defer.inlineCallbacks
+    def _call(self, started):
+        self.in_flight += 1
+        try:
+            yield defer.maybeDeferred(self.f).addCallback(_ensure_deferred)
+        except Exception:
+            self.errors += 1
+            if len(self.failures) < self.max_failures:
+                self.failures.append(failure.Failure().getErrorMessage())
+        else:
+            self.histogram.record(_timer() - started)
+        finally:
+            self.in_flight -= 1
+
+    @defer.inlineCallbacks
+    def _worker(self):
+        while self._can_start():
+            self.launched += 1
+            yield self._call(_timer())
+
+    def _tick(self):
+        now = _timer()
+        while self._can_start() and self._next <= now:
+            # latency counts from when the call was due, not when a free
+            # slot let it start, to avoid coordinated omission
+            self.backlog.append(self._next)
+            self.launched += 1
+            self._next = self.started + self.launched / float(self.rate)
+        self._drain()
+
+        if self._can_start():
+            self.reactor.callLater(max(0, self._next - _timer()), self._tick)
+        else:
+            self.ticking = False
+            self._maybe_finish()
+
+    def _drain(self):
+        if self.draining:
+            # a call finished synchronously, the loop below takes its slot
+            return
+
+        self.draining = True
+        try:
+            while self.backlog and (
+                self.concurrency is None or self.in_flight < self.concurrency
+            ):
+                d = self._call(self.backlog.pop(0))
+                d.addCallback(self._call_done)
+        finally:
+            self.draining = False
+
+    def _call_done(self, ignored):
+        self._drain()
+        self._maybe_finish()
+
+    def _maybe_finish(self):
+        if self.ticking or self.in_flight or self.backlog:
+            return
+
+        self._finish()
+
+    def _finish(self, ignored=None):
+        if self.done.called:
+            return
+
+        self.done.callback(LoadStats(
+            histogram=self.histogram,
+            errors=self.errors,
+            failures=self.failures,
+            elapsed=_timer() - self.started,
+        ))
+
+    def start(self):
+        self.started = _timer()
+        self.deadline = None
+        if self.duration is not None:
+            self.deadline = self.started + self.duration
+
+        if self.rate is not None:
+            self.ticking = True
+            self._next = self.started
+            self._tick()
+        else:
+            workers = [self._worker() for _ in range(self.concurrency)]
+            defer.gatherResults(workers).addCallback(self._finish)
+
+        return self.done
+
+
+def run_load(
+        f,
+        concurrency=None,
+        rate=None,
+        duration=None,
+        iterations=None,
+):
+    """Call ``f`` repeatedly on the reactor and collect its latencies.
+
+    ``f`` takes no arguments and may return a Deferred, a coroutine or a
+    plain value.  With ``rate`` calls are started at that many per second,
+    at most ``concurrency`` at a time if given.  Otherwise ``concurrency``
+    (default 1) calls are kept in flight.  The run ends after ``duration``
+    seconds or ``iterations`` calls, whichever comes first.  Returns a
+    Deferred firing with :class:`LoadStats`.
+    """
+    if duration is None and iterations is None:
+        raise ValueError('run_load() needs a duration or iterations')
+    if concurrency is None and rate is None:
+        concurrency = 1
+
+    return _LoadRunner(
+        f=f,
+        concurrency=concurrency,
+        rate=rate,
+        duration=duration,
+        iterations=iterations,
+        reactor=_instances.reactor,
+    ).start()
+
+
+class _TwistedLoad(object):
+    summary_fields = (
+        'count', 'errors', 'throughput', 'p50', 'p99', 'p999', 'max',
+    )
+
+    def __init__(self):
+        self.results = []
+
+    def __call__(self, f, **kwargs):
+        d = run_load(f, **kwargs)
+        d.addCallback(self._record)
+        return d
+
+    def _record(self, stats):
+        self.results.append(
+            dict((name, getattr(stats, name)) for name in self.summary_fields)
+        )
+        return stats
+
+
+@pytest.fixture
+def twisted_load(request):
+    load = _TwistedLoad()
+    # picked up with the call report, see _record_load
+    request.node._twisted_load = load
+    return load
+
+
+def _record_load(report):
+    # as for benchmarks, this brings in the runs from fork children and
+    # reactor workers
+    results = getattr(report, 'twisted_load', None)
+    if report.when == 'call' and results is not None:
+        _instances.load_results.extend(
+            (report.nodeid, stats) for stats in results
+        )
+
+
+def _summarize_load(terminalreporter):
+    if not _instances.load_results:
+        return
+
+    terminalreporter.write_sep("-", "twisted load")
+    for nodeid, stats in _instances.load_results:
+        terminalreporter.write_line(
+            "{}: {} calls, {} errors, {:.1f}/s,"
+            " p50 {:.6f}s, p99 {:.6f}s, p999 {:.6f}s, max {:.6f}s".format(
+                nodeid,
+                stats['count'],
+                stats['errors'],
+                stats['throughput'],
+                stats['p50'],
+                stats['p99'],
+                stats['p999'],
+                stats['max'],
+            )
+        )
+
+
+def _configure_benchmark(config):
+    _config.benchmark_json = config.getoption('twisted_benchmark_json')
+    _config.benchmark_max_time = config.getoption(
+        'twisted_benchmark_max_time',
+    )
+    _config.benchmark_min_rounds = config.getoption(
+        'twisted_benchmark_min_rounds',
+    )
+
+
+def _write_benchmark_json(path):
+    import datetime
+    import platform
+
+    with open(path, 'w') as f:
+        json.dump(
+            {
+                'machine_info': {
+                    'node': platform.node(),
+                    'processor': platform.processor(),
+                    'machine': platform.machine(),
+                    'python_implementation': (
+                        platform.python_implementation()
+                    ),
+                    'python_version': platform.python_version(),
+                    'system': platform.system(),
+                    'release': platform.release(),
+                },
+                'commit_info': {},
+                'benchmarks': _instances.benchmarks,
+                'datetime': datetime.datetime.utcnow().isoformat(),
+                'version': None,
+            },
+            f,
+            indent=4,
+        )
+
+
+def _record_benchmark(report):
+    # the results travel on the call report so the ones from fork children
+    # and reactor workers end up here too
+    benchmark = getattr(report, 'twisted_benchmark', None)
+    if report.when == 'call' and benchmark is not None:
+        _instances.benchmarks.append(benchmark)
+
+
+def _summarize_benchmarks(terminalreporter):
+    if not _instances.benchmarks:
+        return
+
+    terminalreporter.write_sep("-", "twisted benchmarks")
+    for benchmark in _instances.benchmarks:
+        stats = benchmark['stats']
+        terminalreporter.write_line(
+            "{}: mean {:.6f}s, min {:.6f}s, max {:.6f}s,"
+            " cpu mean {:.6f}s ({} rounds of {})".format(
+                benchmark['fullname'],
+                stats['mean'],
+                stats['min'],
+                stats['max'],
+                benchmark['extra_info']['cpu']['mean'],
+                stats['rounds'],
+                stats['iterations'],
+            )
+        )
+
+
+_durations_key = 'pytest_twisted/durations'
+
+
+def _configure_durations(config):
+    _config.longest_first = config.getoption('twisted_longest_first')
+    _config.weights = config.getoption('twisted_weights')
+    _config.durations_decay = config.getoption('twisted_durations_decay')
+    _config.durations_max_age = config.getoption('twisted_durations_max_age')
+
+
+def _is_xdist_worker(config):
+    # pytest-xdist workers report to the controller, which sees every test
+    return hasattr(config, 'workerinput') or hasattr(config, 'slaveinput')
+
+
+def _load_durations(config):
+    cache = getattr(config, 'cache', None)
+    if cache is None:
+        return {}
+
+    return cache.get(_durations_key, {})
+
+
+def _record_duration(report):
+    wall, reactor = _instances.durations.get(report.nodeid, (0.0, 0.0))
+    _instances.durations[report.nodeid] = (
+        wall + getattr(report, 'duration', 0.0),
+        reactor + getattr(report, 'twisted_reactor_time', 0.0),
+    )
+
+
+def _save_durations(config):
+    cache = getattr(config, 'cache', None)
+    if (
+        cache is None
+        or not _instances.durations
+        or _is_xdist_worker(config)
+    ):
+        return
+
+    # an exponential moving average over sessions, entries for tests that
+    # have not run for durations_max_age sessions are dropped
+    decay = _config.durations_decay
+    history = {}
+    for nodeid, entry in _load_durations(config).items():
+        entry['age'] += 1
+        if entry['age'] <= _config.durations_max_age:
+            history[nodeid] = entry
+
+    for nodeid, (wall, reactor) in _instances.durations.items():
+        entry = history.get(nodeid)
+        if entry is None:
+            history[nodeid] = {'wall': wall, 'reactor': reactor, 'age': 0}
+        else:
+            history[nodeid] = {
+                'wall': decay * wall + (1 - decay) * entry['wall'],
+                'reactor': decay * reactor + (1 - decay) * entry['reactor'],
+                'age': 0,
+            }
+
+    cache.set(_durations_key, history)
+
+
+def _order_by_durations(config, items):
+    history = _load_durations(config)
+    known = [
+        history[item.nodeid]['wall']
+        for item in items
+        if item.nodeid in history
+    ]
+    default = sum(known) / len(known) if known else 0.0
+    weights = dict(
+        (item.nodeid, history.get(item.nodeid, {}).get('wall', default))
+        for item in items
+    )
+
+    if _config.longest_first:
+        # tests without history go first, they might be the slow ones
+        items.sort(key=lambda item: (
+            item.nodeid in history,
+            -weights[item.nodeid],
+        ))
+
+    if (
+        _config.weights is not None
+        and _config.worker_fd is None
+        and not _is_xdist_worker(config)
+    ):
+        with open(_config.weights, 'w') as f:
+            json.dump(
+                [
+                    {'nodeid': item.nodeid, 'weight': weights[item.nodeid]}
+                    for item in items
+                ],
+                f,
+                indent=2,
+            )
+
+
+def _configure_fixture_cache(config):
+    _instances.fixture_cache = _FixtureCache.from_config(config)
+    if (
+            _instances.fixture_cache is not None
+            and config.getoption('twisted_cache_clear')
+            and _config.worker_fd is None
+            and not _is_xdist_worker(config)
+    ):
+        _instances.fixture_cache.clear()
+
+
+_process_pool_worker_source = """
+import os
+import pickle
+import struct
+import sys
+import tempfile
+import traceback
+
+directory, large = sys.argv[1], int(sys.argv[2])
+stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+# results go to the original stdout, anything jobs print goes to stderr
+stdout = os.fdopen(os.dup(1), 'wb')
+os.dup2(2, 1)
+
+
+def read(size):
+    data = b''
+    while len(data) < size:
+        chunk = stdin.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def unpack(tagged):
+    kind, value = tagged
+    if kind != 'file':
+        return value
+
+    with open(value, 'rb') as f:
+        data = f.read()
+    os.remove(value)
+    return data
+
+
+def pack(value):
+    if isinstance(value, bytes) and value and len(value) >= large:
+        fd, path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(value)
+        return ('file', path)
+
+    return ('inline', value)
+
+
+while True:
+    header = read(4)
+    if header is None:
+        break
+
+    frame = read(struct.unpack('>I', header)[0])
+    try:
+        func, args, kwargs = pickle.loads(frame)
+        result = (True, pack(func(
+            *[unpack(arg) for arg in args],
+            **dict((name, unpack(arg)) for name, arg in kwargs.items())
+        )))
+    except Exception as e:
+        e.remote_traceback = traceback.format_exc()
+        result = (False, e)
+
+    try:
+        frame = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        frame = pickle.dumps(
+            (False, RuntimeError(traceback.format_exc())),
+            pickle.HIGHEST_PROTOCOL,
+        )
+    stdout.write(struct.pack('>I', len(frame)) + frame)
+    stdout.flush()
+"""
+
+
+class _ProcessPoolWorker(protocol.ProcessProtocol):
+    def __init__(self, pool):
+        self.pool = pool
+        self.buffer = bytearray()
+        self.job = None
+        self.ended = defer.Deferred()
+
+    def send(self, frame):
+        self.transport.write(struct.pack('>I', len(frame)) + frame)
+
+    def outReceived(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= 4:
+            size, = struct.unpack('>I', bytes(self.buffer[:4]))
+            if len(self.buffer) < 4 + size:
+                break
+
+            frame = bytes(self.buffer[4:4 + size])
+            del self.buffer[:4 + size]
+            self.pool._job_done(self, pickle.loads(frame))
+
+    def processEnded(self, reason):
+        self.pool._worker_ended(self, reason)
+        self.ended.callback(None)
+
+
+class _ProcessPool(object):
+    """Warm Python worker processes running jobs off the reactor.
+
+    Jobs are pickled over the workers' stdin and stdout.  Bytes arguments
+    and results of at least ``large`` bytes are written to temporary files
+    instead, which the receiving side reads back and removes.
+    """
+
+    kill_after = 5.0
+
+    def __init__(self, reactor, size, large=1 << 20):
+        self.reactor = reactor
+        self.size = size
+        self.large = large
+        self.workers = []
+        self.idle = []
+        self.queue = []
+        self.stopping = False
+        self.directory = tempfile.mkdtemp(prefix='pytest-twisted-pool-')
+
+    def start(self):
+        for _ in range(self.size):
+            self._spawn()
+        self.reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def _spawn(self):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            path or os.getcwd() for path in sys.path
+        )
+        worker = _ProcessPoolWorker(self)
+        self.reactor.spawnProcess(
+            worker,
+            sys.executable,
+            [
+                sys.executable,
+                '-c',
+                _process_pool_worker_source,
+                self.directory,
+                str(self.large),
+            ],
+            env=env,
+        )
+        self.workers.append(worker)
+        self.idle.append(worker)
+
+    def _pack(self, value):
+        if isinstance(value, bytes) and value and len(value) >= self.large:
+            fd, path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            return ('file', path)
+
+        return ('inline', value)
+
+    def _unpack(self, tagged):
+        kind, value = tagged
+        if kind != 'file':
+            return value
+
+        with open(value, 'rb') as f:
+            data = f.read()
+        os.remove(value)
+        return data
+
+    def submit(self, func, *args, **kwargs):
+        """Call ``func(*args, **kwargs)`` in a worker process.
+
+        ``func``, the arguments and the result must be picklable.  Returns
+        a Deferred firing with the result, or failing with the exception
+        raised in the worker, whose ``remote_traceback`` has the details.
+        """
+        if self.stopping:
+            return defer.fail(RuntimeError('process pool has been stopped'))
+
+        d = defer.Deferred()
+        self.queue.append((func, args, kwargs, d))
+        self._dispatch()
+        return d
+
+    def _dispatch(self):
+        while self.queue and self.idle:
+            func, args, kwargs, d = self.queue.pop(0)
+            try:
+                frame = pickle.dumps(
+                    (
+                        func,
+                        [self._pack(arg) for arg in args],
+                        dict(
+                            (name, self._pack(arg))
+                            for name, arg in kwargs.items()
+                        ),
+                    ),
+                    pickle.HIGHEST_PROTOCOL,
+                )
+            except Exception:
+                d.errback()
+                continue
+
+            worker = self.idle.pop(0)
+            worker.job = d
+            worker.send(frame)
+
+    def _job_done(self, worker, message):
+        ok, value = message
+        d, worker.job = worker.job, None
+        self.idle.append(worker)
+        self._dispatch()
+
+        if ok:
+            d.callback(self._unpack(value))
+        else:
+            d.errback(failure.Failure(value))
+
+    def _worker_ended(self, worker, reason):
+        self.workers.remove(worker)
+        if worker in self.idle:
+            self.idle.remove(worker)
+
+        if worker.job is not None:
+            d, worker.job = worker.job, None
+            d.errback(reason)
+            # replace workers taken down by a job, but not ones which died
+            # on their own, to avoid respawning a broken worker forever
+            if not self.stopping:
+                self._spawn()
+                self._dispatch()
+
+        if not self.workers:
+            queue, self.queue = self.queue, []
+            for _, _, _, d in queue:
+                d.errback(reason)
+
+    def stop(self):
+        self.stopping = True
+        queue, self.queue = self.queue, []
+        for _, _, _, d in queue:
+            d.errback(RuntimeError('process pool has been stopped'))
+
+        ended = defer.gatherResults([
+            worker.ended for worker in self.workers
+        ])
+        for worker in self.workers:
+            worker.transport.closeStdin()
+
+        kill = self.reactor.callLater(self.kill_after, self._kill)
+        ended.addBoth(lambda _: kill.active() and kill.cancel())
+        ended.addBoth(
+            lambda _: shutil.rmtree(self.directory, ignore_errors=True),
+        )
+        return ended
+
+    def _kill(self):
+        for worker in self.workers:
+            try:
+                worker.transport.signalProcess('KILL')
+            except error.ProcessExitedAlready:
+                pass
+
+
+@pytest.fixture(scope="session")
+def twisted_process_pool():
+    if _instances.process_pool is None:
+        size = _config.process_pool_size
+        if size is None:
+            import multiprocessing
+
+            size = multiprocessing.cpu_count()
+
+        pool = _ProcessPool(reactor=_instances.reactor, size=size)
+        if _config.external_reactor:
+            blockingCallFromThread(_instances.reactor, pool.start)
+        else:
+            pool.start()
+        _instances.process_pool = pool
+
+    return _instances.process_pool
+
+
+def _configure_greenlet_per_test(config):
+    _config.greenlet_per_test = config.getoption('twisted_greenlet_per_test')
+    if not _config.greenlet_per_test or _instances.reactor is None:
+        return
+
+    reactor = _instances.reactor
+    call_later = reactor.callLater
+
+    def call_later_in_greenlet(delay, f, *args, **kwargs):
+        # calls scheduled from a test get a greenlet of their own as well
+        if isinstance(greenlet.getcurrent(), _ReactorGreenlet):
+            f = in_greenlet(f)
+        return call_later(delay, f, *args, **kwargs)
+
+    reactor.callLater = call_later_in_greenlet
+
+
+def _configure_fork(config):
+    _config.fork = config.getoption('twisted_fork')
+    _config.fork_chunk = config.getoption('twisted_fork_chunk')
+
+    if _config.fork and not hasattr(os, 'fork'):
+        raise pytest.UsageError(
+            '--twisted-fork requires os.fork(), not available on {}'.format(
+                sys.platform,
+            )
+        )
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_runtestloop(session):
+    if _config.reactors and _config.worker_fd is None:
+        run = _run_reactor_workers
+    elif _config.fork:
+        run = _run_forked
+    else:
+        return None
+
+    if (
+        session.testsfailed
+        and not session.config.option.continue_on_collection_errors
+    ):
+        raise session.Interrupted(
+            '{} error{} during collection'.format(
+                session.testsfailed,
+                's' if session.testsfailed != 1 else '',
+            )
+        )
+
+    if session.config.option.collectonly:
+        return True
+
+    run(session)
+
+    return True
+
+
+def _run_forked(session):
+    for chunk in _fork_chunks(session.items, _config.fork_chunk):
+        if session.shouldfail:
+            raise session.Failed(session.shouldfail)
+        if session.shouldstop:
+            raise session.Interrupted(session.shouldstop)
+
+        _run_forked_chunk(session, chunk)
+
+
+def _fork_chunks(items, size):
+    for _, module_items in itertools.groupby(
+        items,
+        key=lambda item: item.nodeid.split('::')[0],
+    ):
+        module_items = list(module_items)
+        if not size:
+            yield module_items
+            continue
+
+        for start in range(0, len(module_items), size):
+            yield module_items[start:start + size]
+
+
+def _run_forked_chunk(session, items):
+    # The parent installs the reactor so that collection imports get the
+    # requested type but it never runs it, each child starts it afresh.
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        os.close(read_fd)
+        status = 1
+        if _instances.tracer is not None:
+            _instances.tracer.fork_child()
+        try:
+            with os.fdopen(write_fd, 'w') as stream:
+                _run_chunk_in_child(session, items, stream)
+            if _instances.tracer is not None:
+                _instances.tracer.write()
+            status = 0
+        except BaseException:
+            import traceback
+
+            traceback.print_exc()
+        finally:
+            # skip atexit handlers and the rest of the parent's session
+            os._exit(status)
+
+    os.close(write_fd)
+    config = session.config
+    started = set()
+    finished = set()
+
+    with os.fdopen(read_fd) as stream:
+        for line in stream:
+            event = json.loads(line)
+            if event['event'] == 'findings':
+                _instances.worker_findings.append((
+                    'forked {}'.format(items[0].nodeid.split('::')[0]),
+                    event['findings'],
+                ))
+                continue
+
+            index = event['index']
+            item = items[index]
+
+            if event['event'] == 'start':
+                started.add(index)
+                item.ihook.pytest_runtest_logstart(
+                    nodeid=item.nodeid, location=item.location,
+                )
+            elif event['event'] == 'report':
+                report = config.hook.pytest_report_from_serializable(
+                    config=config, data=event['report'],
+                )
+                item.ihook.pytest_runtest_logreport(report=report)
+            elif event['event'] == 'finish':
+                finished.add(index)
+                item.ihook.pytest_runtest_logfinish(
+                    nodeid=item.nodeid, location=item.location,
+                )
+
+                if session.shouldfail or session.shouldstop:
+                    os.kill(pid, signal.SIGKILL)
+                    break
+
+    _, status = os.waitpid(pid, 0)
+    if _instances.tracer is not None:
+        _instances.tracer.merge(pid)
+
+    for index, item in enumerate(items):
+        if index in finished or session.shouldfail or session.shouldstop:
+            continue
+
+        _report_lost_item(
+            item,
+            'forked test process exited with status {}'.format(status),
+            started=index in started,
+        )
+
+
+def _run_chunk_in_child(session, items, stream):
+    from _pytest.runner import runtestprotocol
+
+    config = session.config
+
+    def write(event):
+        stream.write(json.dumps(event) + '\n')
+        stream.flush()
+
+    for index, item in enumerate(items):
+        nextitem = items[index + 1] if index + 1 < len(items) else None
+        write({'event': 'start', 'index': index})
+        started = _clock()
+        for report in runtestprotocol(item, nextitem=nextitem, log=False):
+            write({
+                'event': 'report',
+                'index': index,
+                'report': config.hook.pytest_report_to_serializable(
+                    config=config, report=report,
+                ),
+            })
+        _trace(item.nodeid, 'test', started, tid=_TraceRecorder.main_tid)
+        write({'event': 'finish', 'index': index})
+
+    # the reactor was shut down with the last item's session fixtures
+    write({'event': 'findings', 'findings': _findings()})
+
+
+def _report_lost_item(item, message, started):
+    from _pytest.reports import TestReport
+
+    if not started:
+        item.ihook.pytest_runtest_logstart(
+            nodeid=item.nodeid, location=item.location,
+        )
+
+    report = TestReport(
+        nodeid=item.nodeid,
+        location=item.location,
+        keywords=dict.fromkeys(item.keywords, 1),
+        outcome='failed',
+        longrepr=message,
+        when='call',
+    )
+    item.ihook.pytest_runtest_logreport(report=report)
+    item.ihook.pytest_runtest_logfinish(
+        nodeid=item.nodeid, location=item.location,
+    )
+
+
+def _configure_reactors(config):
+    reactors = config.getoption('twisted_reactors')
+    _config.worker_fd = config.getoption('twisted_worker_fd')
+    if not reactors:
+        return
+
+    if sys.platform == 'win32':
+        # workers report back over an inherited pipe file descriptor
+        raise pytest.UsageError('--reactors is not available on win32')
+
+    _config.reactors = tuple(
+        name.strip() for name in reactors.split(',') if name.strip()
+    )
+    unknown = sorted(set(_config.reactors) - set(reactor_installers))
+    if unknown:
+        raise pytest.UsageError(
+            '--reactors: unknown reactor(s) {}, choose from {}'.format(
+                ', '.join(unknown), ', '.join(sorted(reactor_installers)),
+            )
+        )
+
+    if _config.worker_fd is not None:
+        _instances.worker_stream = os.fdopen(_config.worker_fd, 'w')
+        _instances.worker_config = config
+        _configure_worker_nodeids(config)
+
+
+def _configure_worker_nodeids(config):
+    path = config.getoption('twisted_worker_nodeids')
+    if path is None:
+        return
+
+    with open(path) as f:
+        nodeids = [line.rstrip('\n') for line in f if line.strip()]
+    _config.worker_nodeids = set(nodeids)
+
+    # collect only the files holding the tests of this worker instead of
+    # everything given on the command line
+    rootdir = str(getattr(config, 'rootpath', None) or config.rootdir)
+    paths = []
+    for nodeid in nodeids:
+        path = os.path.normpath(
+            os.path.join(rootdir, nodeid.split('::', 1)[0]),
+        )
+        if path not in paths:
+            paths.append(path)
+    config.args[:] = paths
+
+
+def _marked_reactors(node, reactors):
+    marker = node.get_closest_marker('twisted_reactor')
+    if marker is None:
+        return list(reactors)
+
+    return [name for name in reactors if name in marker.args]
+
+
+class _AsyncSource(object):
+    def __init__(self, source):
+        self.source = source
+        self.started = False
+        self.result = None
+
+    def start(self):
+        self.started = True
+        source = self.source
+        if callable(source):
+            d = defer.maybeDeferred(source).addCallback(_ensure_deferred)
+        else:
+            d = _ensure_deferred(source)
+
+        def done(result):
+            self.result = result
+
+        return d.addBoth(done)
+
+    def value(self):
+        if isinstance(self.result, failure.Failure):
+            self.result.raiseException()
+
+        return self.result
+
+
+def _async_source(source):
+    if not _is_async_source(source):
+        return source
+
+    try:
+        return _instances.async_sources[source]
+    except KeyError:
+        wrapped = _instances.async_sources[source] = _AsyncSource(source)
+        return wrapped
+
+
+def _is_async_source(source):
+    return callable(source) or _is_async_value(source)
+
+
+def _is_async_value(value):
+    return (
+        isinstance(value, defer.Deferred)
+        or getattr(inspect, 'isawaitable', lambda value: False)(value)
+    )
+
+
+def parametrize_async(argnames, argvalues, ids=None, **kwargs):
+    """Like ``pytest.mark.parametrize`` with argvalues from the reactor.
+
+    ``argvalues`` may be a Deferred, a coroutine or a callable returning
+    either, and ``ids`` a Deferred or a coroutine.  They are resolved on the
+    reactor during collection, all those not yet resolved together, and
+    each source only once per session.  A callable ``ids`` makes the id of
+    each value, as with ``pytest.mark.parametrize``.
+    """
+    if _is_async_value(ids):
+        ids = _async_source(ids)
+
+    return pytest.mark.twisted_parametrize_async(
+        argnames,
+        _async_source(argvalues),
+        ids=ids,
+        **kwargs
+    )
+
+
+def _resolve_async_sources():
+    pending = [
+        source
+        for source in _instances.async_sources.values()
+        if not source.started
+    ]
+    if not pending:
+        return
+
+    if _config.fork:
+        raise RuntimeError(
+            'parametrize_async() cannot run the reactor in the --twisted-fork'
+            ' parent process'
+        )
+
+    d = defer.Deferred()
+
+    def start():
+        defer.gatherResults(
+            [source.start() for source in pending],
+        ).chainDeferred(d)
+
+    _instances.reactor.callFromThread(start)
+    blockon(d)
+
+
+def _async_parametrize(metafunc):
+    for mark in metafunc.definition.iter_markers('twisted_parametrize_async'):
+        _resolve_async_sources()
+
+        argnames, argvalues = mark.args
+        kwargs = dict(mark.kwargs)
+        if isinstance(argvalues, _AsyncSource):
+            argvalues = argvalues.value()
+        if isinstance(kwargs.get('ids'), _AsyncSource):
+            kwargs['ids'] = kwargs['ids'].value()
+
+        metafunc.parametrize(argnames, argvalues, **kwargs)
+
+
+def pytest_generate_tests(metafunc):
+    _async_parametrize(metafunc)
+
+    if not _config.reactors:
+        return
+
+    if 'twisted_reactor_type' not in metafunc.fixturenames:
+        metafunc.fixturenames.append('twisted_reactor_type')
+    metafunc.parametrize(
+        'twisted_reactor_type',
+        _marked_reactors(metafunc.definition, _config.reactors),
+    )
+
+
+@pytest.fixture
+def twisted_reactor_type(request):
+    return request.config.getoption('reactor')
+
+
+def _item_reactor(item):
+    callspec = getattr(item, 'callspec', None)
+    params = getattr(callspec, 'params', {})
+    reactor = params.get('twisted_reactor_type')
+    if reactor not in _config.reactors:
+        # tests not parametrized per reactor, or marked for none of the
+        # selected ones and so skipped, run with the first reactor
+        return _config.reactors[0]
+
+    return reactor
+
+
+def pytest_collection_modifyitems(config, items):
+    if _config.longest_first or _config.weights is not None:
+        _order_by_durations(config, items)
+
+    if not _config.reactors or _config.worker_fd is None:
+        return
+
+    reactor = config.getoption('reactor')
+    selected = []
+    deselected = []
+    for item in items:
+        if _config.worker_nodeids is not None:
+            selects = item.nodeid in _config.worker_nodeids
+        else:
+            selects = _item_reactor(item) == reactor
+        if selects:
+            selected.append(item)
+        else:
+            deselected.append(item)
+
+    if deselected:
+        config.hook.pytest_deselected(items=deselected)
+        items[:] = selected
+
+
+def _write_worker_event(event, **kwargs):
+    kwargs['event'] = event
+    _instances.worker_stream.write(json.dumps(kwargs) + '\n')
+    _instances.worker_stream.flush()
+
+
+def pytest_runtest_logstart(nodeid, location):
+    if _instances.worker_stream is not None:
+        _write_worker_event('start', nodeid=nodeid)
+
+
+def pytest_runtest_logfinish(nodeid, location):
+    if _instances.worker_stream is not None:
+        _write_worker_event('finish', nodeid=nodeid)
+
+
+def pytest_runtest_logreport(report):
+    _record_duration(report)
+    _record_io(report)
+    _record_benchmark(report)
+    _record_load(report)
+
+    if _instances.worker_stream is not None:
+        config = _instances.worker_config
+        _write_worker_event(
+            'report',
+            nodeid=report.nodeid,
+            report=config.hook.pytest_report_to_serializable(
+                config=config, report=report,
+            ),
+        )
+
+
+def pytest_sessionfinish(session):
+    if _instances.worker_stream is not None:
+        _write_worker_event('findings', findings=_findings())
+
+
+def _spawn_reactor_worker(config, reactor, nodeids):
+    invocation_params = getattr(config, 'invocation_params', None)
+    if invocation_params is not None:
+        args = list(invocation_params.args)
+        cwd = str(invocation_params.dir)
+    else:
+        args = sys.argv[1:]
+        cwd = None
+
+    with tempfile.NamedTemporaryFile(
+        mode='w', suffix='.nodeids', delete=False,
+    ) as f:
+        f.writelines(nodeid + '\n' for nodeid in nodeids)
+
+    read_fd, write_fd = os.pipe()
+    args = [sys.executable, '-m', 'pytest'] + args + [
+        '--reactor={}'.format(reactor),
+        '--twisted-worker-fd={}'.format(write_fd),
+        '--twisted-worker-nodeids={}'.format(f.name),
+    ]
+    if getattr(config.option, 'xmlpath', None):
+        # only the parent writes the junit report
+        args.append('--junitxml=')
+
+    output = tempfile.TemporaryFile()
+    if sys.version_info >= (3,):
+        kwargs = {'pass_fds': (write_fd,)}
+    else:
+        kwargs = {'close_fds': False}
+    process = subprocess.Popen(
+        args, cwd=cwd, stdout=output, stderr=subprocess.STDOUT, **kwargs
+    )
+    os.close(write_fd)
+
+    return process, os.fdopen(read_fd), output, f.name
+
+
+def _read_worker_events(reactor, stream, events):
+    with stream:
+        for line in stream:
+            events.put((reactor, json.loads(line)))
+    events.put((reactor, None))
+
+
+def _run_reactor_workers(session):
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+
+    config = session.config
+    items = {item.nodeid: item for item in session.items}
+    started = set()
+    finished = set()
+    events = queue.Queue()
+    workers = {}
+
+    nodeids = dict((reactor, []) for reactor in _config.reactors)
+    for item in session.items:
+        nodeids[_item_reactor(item)].append(item.nodeid)
+
+    for reactor in _config.reactors:
+        if not nodeids[reactor]:
+            continue
+
+        process, stream, output, nodeids_path = _spawn_reactor_worker(
+            config, reactor, nodeids[reactor],
+        )
+        reader = threading.Thread(
+            target=_read_worker_events,
+            args=(reactor, stream, events),
+            name='pytest_twisted {} worker reader'.format(reactor),
+        )
+        reader.daemon = True
+        reader.start()
+        workers[reactor] = (process, output, nodeids_path)
+
+    running = len(workers)
+    while running:
+        reactor, event = events.get()
+        if event is None:
+            running -= 1
+            continue
+
+        if event['event'] == 'findings':
+            _instances.worker_findings.append((
+                '{} reactor worker'.format(reactor), event['findings'],
+            ))
+            continue
+
+        item = items.get(event['nodeid'])
+        if item is None:
+            continue
+
+        if event['event'] == 'start':
+            started.add(item.nodeid)
+            item.ihook.pytest_runtest_logstart(
+                nodeid=item.nodeid, location=item.location,
+            )
+        elif event['event'] == 'report':
+            report = config.hook.pytest_report_from_serializable(
+                config=config, data=event['report'],
+            )
+            item.ihook.pytest_runtest_logreport(report=report)
+        elif event['event'] == 'finish':
+            finished.add(item.nodeid)
+            item.ihook.pytest_runtest_logfinish(
+                nodeid=item.nodeid, location=item.location,
+            )
+
+            if session.shouldfail or session.shouldstop:
+                for process, _, _ in workers.values():
+                    process.kill()
+
+    messages = {}
+    for reactor, (process, output, nodeids_path) in workers.items():
+        status = process.wait()
+        os.remove(nodeids_path)
+        if _instances.tracer is not None:
+            _instances.tracer.merge(process.pid)
+        output.seek(0)
+        messages[reactor] = (
+            '{} reactor worker exited with status {}\n{}'.format(
+                reactor,
+                status,
+                output.read().decode('utf-8', 'replace'),
+            )
+        )
+        output.close()
+
+    if session.shouldfail or session.shouldstop:
+        return
+
+    for item in session.items:
+        if item.nodeid in finished:
+            continue
+
+        _report_lost_item(
+            item,
+            messages[_item_reactor(item)],
+            started=item.nodeid in started,
+        )
+
+
+def init_default_reactor():
+    import twisted.internet.default
+
+    module = inspect.getmodule(twisted.internet.default.install)
+
+    module_name = module.__name__.split(".")[-1]
+    reactor_type_name, = (x for x in dir(module) if x.lower() == module_name)
+    reactor_type = getattr(module, reactor_type_name)
+
+    _install_reactor(
+        reactor_installer=twisted.internet.default.install,
+        reactor_type=reactor_type,
+    )
+
+
+def init_qt5_reactor():
+    import qt5reactor
+
+    _install_reactor(
+        reactor_installer=qt5reactor.install, reactor_type=qt5reactor.QtReactor
+    )
+
+
+def _import_object(path):
+    import importlib
+
+    if ':' in path:
+        module_name, _, name = path.partition(':')
+    else:
+        module_name, _, name = path.rpartition('.')
+
+    obj = importlib.import_module(module_name)
+    for attribute in name.split('.'):
+        obj = getattr(obj, attribute)
+
+    return obj
+
+
+def _new_asyncio_loop(path):
+    import asyncio
+
+    created = _import_object(path)()
+    if isinstance(created, asyncio.AbstractEventLoopPolicy):
+        asyncio.set_event_loop_policy(created)
+        created = created.new_event_loop()
+
+    if not isinstance(created, asyncio.AbstractEventLoop):
+        raise TypeError(
+            '{} did not create an event loop or policy: {!r}'.format(
+                path, created,
+            )
+        )
+
+    return created
+
+
+def init_asyncio_reactor():
+    from twisted.internet import asyncioreactor
+
+    if _config.asyncio_loop is None:
+        _install_reactor(
+            reactor_installer=asyncioreactor.install,
+            reactor_type=asyncioreactor.AsyncioSelectorReactor,
+        )
+        return
+
+    loop = _new_asyncio_loop(_config.asyncio_loop)
+    try:
+        _install_reactor(
+            reactor_installer=functools.partial(
+                asyncioreactor.install,
+                eventloop=loop,
+            ),
+            reactor_type=asyncioreactor.AsyncioSelectorReactor,
+            loop_type=type(loop),
+        )
+    finally:
+        # unused when the reactor had already been installed
+        if getattr(_instances.reactor, '_asyncioEventloop', None) is loop:
+            import asyncio
+
+            asyncio.set_event_loop(loop)
+        else:
+            loop.close()
+
+
+reactor_installers = {
+    "default": init_default_reactor,
+    "qt5reactor": init_qt5_reactor,
+    "asyncio": init_asyncio_reactor,
+}
+
+
+def _install_reactor(reactor_installer, reactor_type, loop_type=None):
+    try:
+        reactor_installer()
+    except error.ReactorAlreadyInstalledError:
+        import twisted.internet.reactor
+
+        if not isinstance(twisted.internet.reactor, reactor_type):
+            raise WrongReactorAlreadyInstalledError(
+                "expected {} but found {}".format(
+                    reactor_type, type(twisted.internet.reactor)
+                )
+            )
+
+        loop = getattr(twisted.internet.reactor, '_asyncioEventloop', None)
+        if loop_type is not None and not isinstance(loop, loop_type):
+            raise WrongReactorAlreadyInstalledError(
+                "expected {} on a {} but found {}".format(
+                    reactor_type, loop_type, type(loop)
+                )
+            )
+
+    import twisted.internet.reactor
+
+    _instances.reactor = twisted.internet.reactor
+    init_twisted_greenlet()
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("twisted")
+    group.addoption(
+        "--reactor",
+        default="default",
+        choices=tuple(reactor_installers.keys()),
+    )
+    group.addoption(
+        "--twisted-engine",
+        dest="twisted_engine",
+        default="greenlet",
+        choices=("greenlet", "step"),
+        help=(
+            "how the reactor is run: in a greenlet (default) or stepped from"
+            " the main thread while waiting on a test or blockon()"
+        ),
+    )
+    group.addoption(
+        "--twisted-greenlet-per-test",
+        dest="twisted_greenlet_per_test",
+        action="store_true",
+        default=False,
+        help=(
+            "run each test, and the calls it schedules with callLater, in a"
+            " greenlet of its own in which blockon() can wait"
+        ),
+    )
+    group.addoption(
+        "--twisted-io-stats",
+        dest="twisted_io_stats",
+        action="store_true",
+        default=False,
+        help=(
+            "count connections, bytes and read/write callbacks of the"
+            " reactor's sockets per test"
+        ),
+    )
+    group.addoption(
+        "--twisted-trial",
+        dest="twisted_trial",
+        action="store_true",
+        default=False,
+        help=(
+            "run twisted.trial TestCase classes on the session reactor"
+            " instead of with trial's own reactor spinning"
+        ),
+    )
+    group.addoption(
+        "--twisted-trial-dirty-reactor",
+        dest="twisted_trial_dirty_reactor",
+        action="store_true",
+        default=False,
+        help=(
+            "with --twisted-trial, fail tests which leave delayed calls or"
+            " selectables behind in the reactor"
+        ),
+    )
+    group.addoption(
+        "--twisted-asyncio-loop",
+        dest="twisted_asyncio_loop",
+        default=None,
+        metavar="module:callable",
+        help=(
+            "with --reactor=asyncio, run the reactor on the event loop, or the"
+            " loop of the event loop policy, returned by this callable, e.g."
+            " uvloop:new_event_loop"
+        ),
+    )
+    parser.addini(
+        "twisted_asyncio_loop",
+        "default for --twisted-asyncio-loop",
+    )
+    group.addoption(
+        "--reactors",
+        dest="twisted_reactors",
+        default=None,
+        help=(
+            "comma separated reactors to run every test with, each in its"
+            " own worker process, e.g. default,asyncio"
+        ),
+    )
+    group.addoption(
+        "--twisted-worker-fd",
+        dest="twisted_worker_fd",
+        type=int,
+        default=None,
+        help=argparse.SUPPRESS,
+    )
+    group.addoption(
+        "--twisted-worker-nodeids",
+        dest="twisted_worker_nodeids",
+        default=None,
+        help=argparse.SUPPRESS,
+    )
+    group.addoption(
+        "--twisted-fork",
+        dest="twisted_fork",
+        action="store_true",
+        default=False,
+        help=(
+            "collect once and then run each test module in a forked child"
+            " process with its own freshly installed reactor"
+        ),
+    )
+    group.addoption(
+        "--twisted-fork-chunk",
+        dest="twisted_fork_chunk",
+        type=int,
+        default=0,
+        help=(
+            "with --twisted-fork, run at most this many tests per child"
+            " (default: a whole module per child)"
+        ),
+    )
+    group.addoption(
+        "--twisted-longest-first",
+        dest="twisted_longest_first",
+        action="store_true",
+        default=False,
+        help=(
+            "run tests in order of their recorded durations, longest first,"
+            " with tests not seen before at the front"
+        ),
+    )
+    group.addoption(
+        "--twisted-weights",
+        dest="twisted_weights",
+        default=None,
+        metavar="path",
+        help=(
+            "write the recorded duration of each collected test as a JSON"
+            " weight for load balancing schedulers"
+        ),
+    )
+    group.addoption(
+        "--twisted-durations-decay",
+        dest="twisted_durations_decay",
+        type=float,
+        default=0.5,
+        help=(
+            "weight of the latest run in the recorded test durations"
+            " (default: 0.5)"
+        ),
+    )
+    group.addoption(
+        "--twisted-durations-max-age",
+        dest="twisted_durations_max_age",
+        type=int,
+        default=10,
+        help=(
+            "forget recorded durations of tests that have not run for this"
+            " many sessions (default: 10)"
+        ),
+    )
+    group.addoption(
+        "--twisted-cache-clear",
+        dest="twisted_cache_clear",
+        action="store_true",
+        default=False,
+        help="remove cached async_fixture results before the run",
+    )
+    group.addoption(
+        "--twisted-process-pool-size",
+        dest="twisted_process_pool_size",
+        type=int,
+        default=None,
+        help=(
+            "number of worker processes in twisted_process_pool (default:"
+            " the number of CPUs)"
+        ),
+    )
+    group.addoption(
+        "--twisted-trace",
+        dest="twisted_trace",
+        default=None,
+        metavar="path",
+        help=(
+            "write a Chrome trace event file of the reactor timeline, for"
+            " loading into Perfetto"
+        ),
+    )
+    group.addoption(
+        "--twisted-benchmark-json",
+        dest="twisted_benchmark_json",
+        default=None,
+        metavar="path",
+        help="write twisted_benchmark results in pytest-benchmark's format",
+    )
+    group.addoption(
+        "--twisted-benchmark-max-time",
+        dest="twisted_benchmark_max_time",
+        type=float,
+        default=1.0,
+        help="seconds to keep adding twisted_benchmark rounds for",
+    )
+    group.addoption(
+        "--twisted-benchmark-min-rounds",
+        dest="twisted_benchmark_min_rounds",
+        type=int,
+        default=5,
+        help="minimum number of rounds for each twisted_benchmark",
+    )
+    group.addoption(
+        "--twisted-threadpool-min",
+        dest="twisted_threadpool_min",
+        type=int,
+        default=None,
+        help="minimum number of threads in the reactor thread pool",
+    )
+    group.addoption(
+        "--twisted-threadpool-max",
+        dest="twisted_threadpool_max",
+        type=int,
+        default=None,
+        help="maximum number of threads in the reactor thread pool",
+    )
+    group.addoption(
+        "--twisted-threadpool-join-timeout",
+        dest="twisted_threadpool_join_timeout",
+        type=float,
+        default=None,
+        help=(
+            "seconds to wait for reactor thread pool workers at shutdown"
+            " before reporting them as stuck"
+        ),
+    )
+    group.addoption(
+        "--twisted-shutdown-timeout",
+        dest="twisted_shutdown_timeout",
+        type=float,
+        default=None,
+        help=(
+            "seconds to wait for before-shutdown triggers at the end of the"
+            " session before stopping the reactor regardless"
+        ),
+    )
+    group.addoption(
+        "--twisted-abort-timeout",
+        dest="twisted_abort_timeout",
+        type=float,
+        default=2.0,
+        help=(
+            "seconds to allow for reactor shutdown when the session stops"
+            " early on Ctrl-C, -x or --maxfail (default: 2)"
+        ),
+    )
+    group.addoption(
+        "--twisted-shutdown-slow",
+        dest="twisted_shutdown_slow",
+        type=float,
+        default=1.0,
+        help="report shutdown triggers taking at least this many seconds",
+    )
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_cmdline_main(config):
+    # before any conftest pytest_configure() is able to install the reactor
+    _config.engine = config.getoption("twisted_engine")
 
 
 def pytest_configure(config):
@@ -326,7 +3521,217 @@ def pytest_configure(config):
         recommended='pytest_twisted.blockon',
     )(blockon)
 
+    _configure_shutdown(config)
+    _configure_trial(config)
+    _configure_benchmark(config)
+    _configure_fork(config)
+    _configure_reactors(config)
+    _configure_durations(config)
+    _configure_fixture_cache(config)
+    _config.process_pool_size = config.getoption('twisted_process_pool_size')
+    _config.asyncio_loop = (
+        config.getoption('twisted_asyncio_loop')
+        or config.getini('twisted_asyncio_loop')
+        or None
+    )
+    config.addinivalue_line(
+        "markers",
+        "twisted_reactor(*names): only run the test with these reactors",
+    )
+    config.addinivalue_line(
+        "markers",
+        "twisted_parametrize_async(argnames, argvalues, ids=None):"
+        " parametrize from an async source, see parametrize_async()",
+    )
+
     reactor_installers[config.getoption("reactor")]()
+    _configure_threadpool(config)
+    _configure_trace(config)
+    _configure_greenlet_per_test(config)
+    _configure_io_stats(config)
+
+
+def pytest_sessionstart(session):
+    _instances.session = session
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_protocol(item, nextitem):
+    started = _clock()
+    yield
+    _trace(item.nodeid, 'test', started, tid=_TraceRecorder.main_tid)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_fixture_setup(fixturedef, request):
+    started = _clock()
+    yield
+    _trace('fixture {}'.format(fixturedef.argname), 'fixture', started)
+
+
+def pytest_unconfigure(config):
+    if _instances.tracer is not None:
+        _instances.tracer.write()
+    if _config.benchmark_json is not None and _config.worker_fd is None:
+        _write_benchmark_json(_config.benchmark_json)
+    if _config.worker_fd is None:
+        _save_durations(config)
+
+
+def pytest_runtest_setup(item):
+    if not _config.reactors:
+        reactor = item.config.getoption('reactor')
+        if not _marked_reactors(item, [reactor]):
+            pytest.skip('test does not run with the {} reactor'.format(
+                reactor,
+            ))
+
+    if _instances.threadpool_monitor is not None:
+        _instances.threadpool_monitor.reset()
+    if _instances.io_monitor is not None:
+        _instances.io_monitor.reset()
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_runtest_teardown(item):
+    if _instances.threadpool_monitor is not None:
+        item.user_properties.extend(
+            _instances.threadpool_monitor.user_properties(),
+        )
+    if _instances.io_monitor is not None:
+        item.user_properties.extend(_instances.io_monitor.user_properties())
+
+
+def pytest_terminal_summary(terminalreporter):
+    _summarize_shutdown(terminalreporter)
+    _summarize_threadpool(terminalreporter)
+    _summarize_benchmarks(terminalreporter)
+    _summarize_load(terminalreporter)
+    _summarize_io(terminalreporter)
+
+
+def _findings():
+    """Shutdown and thread pool results of this process, as plain data.
+
+    Fork children and reactor workers send them to the parent, which
+    reports them along with its own, see ``worker_findings``.
+    """
+    findings = {}
+
+    manager = _instances.shutdown_manager
+    if manager is not None:
+        findings['shutdown'] = {
+            'timeout': manager.timeout,
+            'timed_out': manager.timed_out,
+            'interrupted': manager.interrupted,
+            'stuck': manager.stuck,
+            'failed': manager.failed,
+            'slow': manager.slow_triggers(),
+        }
+
+    monitor = _instances.threadpool_monitor
+    if monitor is not None:
+        findings['threadpool'] = {
+            'min': monitor.pool.min,
+            'max': monitor.pool.max,
+            'max_queue_depth': monitor.session_max_queue_depth,
+            'max_wait': monitor.session_max_wait,
+            'stuck': monitor.stuck,
+        }
+
+    return findings
+
+
+def _all_findings(kind):
+    for source, findings in [(None, _findings())] + _instances.worker_findings:
+        if kind in findings:
+            prefix = '' if source is None else '{}: '.format(source)
+            yield prefix, findings[kind]
+
+
+def _shutdown_lines(shutdown):
+    if shutdown['timed_out'] and shutdown['interrupted']:
+        yield "shutdown interrupted, reactor stopped forcibly"
+    elif shutdown['timed_out']:
+        yield (
+            "shutdown deadline of {}s exceeded,"
+            " reactor stopped forcibly".format(shutdown['timeout'])
+        )
+    for description in shutdown['stuck']:
+        yield "stuck shutdown trigger: {}".format(description)
+    for description in shutdown['failed']:
+        yield "failed shutdown trigger: {}".format(description)
+    for description, duration in shutdown['slow']:
+        yield "slow shutdown trigger: {} ({:.3f}s)".format(
+            description, duration,
+        )
+
+
+def _summarize_shutdown(terminalreporter):
+    lines = [
+        prefix + line
+        for prefix, shutdown in _all_findings('shutdown')
+        for line in _shutdown_lines(shutdown)
+    ]
+    if not lines:
+        return
+
+    terminalreporter.write_sep("-", "twisted shutdown")
+    for line in lines:
+        terminalreporter.write_line(line)
+
+
+def _summarize_threadpool(terminalreporter):
+    pools = list(_all_findings('threadpool'))
+    if not pools:
+        return
+
+    terminalreporter.write_sep("-", "twisted thread pool")
+    terminalreporter.write_line(
+        "threads: min={} max={}, max queue depth: {}, max wait: {:.3f}s"
+        .format(
+            pools[0][1]['min'],
+            pools[0][1]['max'],
+            max(pool['max_queue_depth'] for _, pool in pools),
+            max(pool['max_wait'] for _, pool in pools),
+        )
+    )
+    for prefix, pool in pools:
+        for description in pool['stuck']:
+            terminalreporter.write_line(
+                "{}stuck worker: {}".format(prefix, description),
+            )
+
+
+def _summarize_io(terminalreporter, limit=10):
+    results = _instances.io_results
+    if not results:
+        return
+
+    totals = dict.fromkeys(_IOMonitor.fields, 0)
+    for _, counts in results:
+        for field in totals:
+            totals[field] += counts.get(field, 0)
+
+    def line(counts):
+        return (
+            "{connections} connections, {bytes_read} bytes read,"
+            " {bytes_written} bytes written, {read_callbacks} reads,"
+            " {write_callbacks} writes".format(**counts)
+        )
+
+    terminalreporter.write_sep("-", "twisted socket I/O")
+    terminalreporter.write_line("total: {}".format(line(totals)))
+
+    def callbacks(result):
+        _, counts = result
+        return counts['read_callbacks'] + counts['write_callbacks']
+
+    busiest = sorted(results, key=callbacks, reverse=True)[:limit]
+    for nodeid, counts in busiest:
+        if callbacks((nodeid, counts)) == 0:
+            break
+        terminalreporter.write_line("{}: {}".format(nodeid, line(counts)))
 
 
 def _use_asyncio_selector_if_required(config):
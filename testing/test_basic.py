@@ -1,3 +1,6 @@
+import json
+import os
+import re
 import sys
 import textwrap
 
@@ -70,6 +73,14 @@ def skip_if_reactor_not(request, expected_reactor):
         )
 
 
+def skip_if_engine_not(request, expected_engine):
+    actual_engine = request.config.getoption("twisted_engine", "greenlet")
+    if actual_engine != expected_engine:
+        pytest.skip(
+            "engine is {} not {}".format(actual_engine, expected_engine),
+        )
+
+
 def skip_if_no_async_await():
     return pytest.mark.skipif(
         not ASYNC_AWAIT,
@@ -84,10 +95,39 @@ def skip_if_no_async_generators():
     )
 
 
+def parametrize_processes():
+    # run in process, in a reactor worker and in a fork child
+    return pytest.mark.parametrize(
+        "opts",
+        [
+            pytest.param([], id="in-process"),
+            pytest.param(
+                ["--reactors=default"],
+                id="reactors",
+                marks=pytest.mark.skipif(
+                    sys.platform == "win32",
+                    reason="--reactors is not available on win32",
+                ),
+            ),
+            pytest.param(
+                ["--twisted-fork"],
+                id="fork",
+                marks=pytest.mark.skipif(
+                    not hasattr(os, "fork"), reason="requires os.fork()",
+                ),
+            ),
+        ],
+    )
+
+
 @pytest.fixture
 def cmd_opts(request):
     reactor = request.config.getoption("reactor", "default")
-    return ("--reactor={}".format(reactor),)
+    engine = request.config.getoption("twisted_engine", "greenlet")
+    return (
+        "--reactor={}".format(reactor),
+        "--twisted-engine={}".format(engine),
+    )
 
 
 def test_inline_callbacks_in_pytest():
@@ -269,7 +309,8 @@ def test_async_await(testdir, cmd_opts):
     assert_outcomes(rr, {"passed": 2, "failed": 1})
 
 
-def test_twisted_greenlet(testdir, cmd_opts):
+def test_twisted_greenlet(testdir, cmd_opts, request):
+    skip_if_engine_not(request, "greenlet")
     test_file = """
     import pytest, greenlet
 
@@ -696,3 +737,1208 @@ def test_wrong_reactor_with_asyncio(testdir, cmd_opts, request):
     testdir.makepyfile(test_file)
     rr = testdir.run(sys.executable, "-m", "pytest", "-v", *cmd_opts)
     assert "WrongReactorAlreadyInstalledError" in rr.stderr.str()
+
+
+def test_threadpool_size_and_stats(testdir, cmd_opts):
+    test_file = """
+    import threading
+
+    from twisted.internet import reactor, defer, threads
+
+    def test_size():
+        pool = reactor.getThreadPool()
+        assert (pool.min, pool.max) == (1, 1)
+
+    def test_queued():
+        gate = threading.Event()
+        ds = [threads.deferToThread(gate.wait, 5) for _ in range(4)]
+        reactor.callLater(0.05, gate.set)
+        return defer.gatherResults(ds)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "-v",
+        "--twisted-threadpool-min=1",
+        "--twisted-threadpool-max=1",
+        "--junitxml=junit.xml",
+        *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 2})
+    rr.stdout.fnmatch_lines(["*twisted thread pool*", "threads: min=1 max=1*"])
+    junit = testdir.tmpdir.join("junit.xml").read()
+    # with a single worker at least three of the four calls had to queue
+    depths = re.findall(
+        r'name="twisted_threadpool_max_queue_depth" value="(\d+)"', junit,
+    )
+    assert [int(depth) >= 3 for depth in depths] == [False, True]
+
+
+@parametrize_processes()
+def test_threadpool_join_timeout_reports_stuck_workers(
+    testdir, cmd_opts, opts,
+):
+    test_file = """
+    import time
+
+    from twisted.internet import reactor
+
+    def test_leak_worker():
+        reactor.callInThread(time.sleep, 30)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "-v",
+        "--twisted-threadpool-join-timeout=0.1",
+        *(list(opts) + list(cmd_opts)),
+        timeout=20
+    )
+    assert_outcomes(rr, {"passed": 1})
+    rr.stdout.fnmatch_lines(["*stuck worker: *sleep*"])
+
+
+@parametrize_processes()
+def test_shutdown_timeout_reports_stuck_triggers(testdir, cmd_opts, opts):
+    test_file = """
+    from twisted.internet import reactor, defer, task
+
+    def hang():
+        return defer.Deferred()
+
+    def linger():
+        return task.deferLater(reactor, 0.2, lambda: None)
+
+    def test_register():
+        reactor.addSystemEventTrigger("before", "shutdown", hang)
+        reactor.addSystemEventTrigger("before", "shutdown", linger)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "-v",
+        "--twisted-shutdown-timeout=1",
+        "--twisted-shutdown-slow=0.1",
+        *(list(opts) + list(cmd_opts)),
+        timeout=20
+    )
+    assert_outcomes(rr, {"passed": 1})
+    rr.stdout.fnmatch_lines([
+        "*twisted shutdown*",
+        "*shutdown deadline of 1.0s exceeded, reactor stopped forcibly",
+        "*stuck shutdown trigger: *hang",
+        "*slow shutdown trigger: *linger (*s)",
+    ])
+
+
+def test_step_engine(testdir, cmd_opts):
+    test_file = """
+    import greenlet
+    import pytest
+    import pytest_twisted
+    from twisted.internet import reactor, defer, task
+
+    def test_no_greenlet(twisted_greenlet):
+        assert twisted_greenlet is None
+        assert greenlet.getcurrent().parent is None
+
+    def test_blockon_in_test():
+        d = task.deferLater(reactor, 0.01, lambda: 42)
+        assert pytest_twisted.blockon(d) == 42
+
+    def test_blockon_in_reactor_callback():
+        def nested():
+            pytest_twisted.blockon(defer.succeed(None))
+
+        d = task.deferLater(reactor, 0, nested)
+        with pytest.raises(AssertionError, match="stepped reactor"):
+            pytest_twisted.blockon(d)
+
+    @pytest_twisted.inlineCallbacks
+    def test_inline_callbacks():
+        yield task.deferLater(reactor, 0.01, lambda: None)
+        with pytest.raises(ZeroDivisionError):
+            yield task.deferLater(reactor, 0.01, lambda: 1 / 0)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "-v",
+        *cmd_opts + ("--twisted-engine=step",)
+    )
+    assert_outcomes(rr, {"passed": 4})
+
+
+def test_trial_test_case(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import reactor, defer, task
+    from twisted.trial import unittest
+
+    calls = []
+
+    class Legacy(unittest.TestCase):
+        def setUp(self):
+            calls.append("setUp")
+            return task.deferLater(reactor, 0.01, lambda: None)
+
+        def tearDown(self):
+            calls.append("tearDown")
+
+        def test_a_deferred(self):
+            self.addCleanup(calls.append, "cleanup")
+            self.assertTrue(reactor.running)
+            return task.deferLater(reactor, 0.01, calls.append, "test")
+
+        def test_b_order(self):
+            self.assertEqual(
+                calls[:4], ["setUp", "test", "cleanup", "tearDown"],
+            )
+
+        def test_failure(self):
+            return defer.fail(RuntimeError("foo"))
+
+        def test_skip(self):
+            pass
+        test_skip.skip = "not today"
+
+        def test_todo(self):
+            self.fail("expected")
+        test_todo.todo = "known"
+
+        def test_dirty(self):
+            reactor.callLater(30, lambda: None)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "-v", "--twisted-trial", *cmd_opts
+    )
+    assert_outcomes(
+        rr, {"passed": 3, "failed": 1, "skipped": 1, "xfailed": 1},
+    )
+
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "-v",
+        "--twisted-trial",
+        "--twisted-trial-dirty-reactor",
+        *cmd_opts
+    )
+    assert_outcomes(
+        rr, {"passed": 2, "failed": 2, "skipped": 1, "xfailed": 1},
+    )
+    rr.stdout.fnmatch_lines(["*DirtyReactorAggregateError*"])
+
+
+def test_trial_logged_errors_and_todo(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import reactor, task
+    from twisted.python import log
+    from twisted.trial import unittest
+
+    class Legacy(unittest.TestCase):
+        def test_flushed(self):
+            log.err(ZeroDivisionError("flushed"))
+            errors = self.flushLoggedErrors(ZeroDivisionError)
+            self.assertEqual(len(errors), 1)
+
+        def test_logged_later(self):
+            def fail():
+                log.err(ValueError("flushed later"))
+
+            d = task.deferLater(reactor, 0, fail)
+            d.addCallback(lambda _: self.flushLoggedErrors(ValueError))
+            d.addCallback(lambda errors: self.assertEqual(len(errors), 1))
+            return d
+
+        def test_unflushed(self):
+            log.err(KeyError("unflushed"))
+
+        def test_todo_passes(self):
+            pass
+        test_todo_passes.todo = "not fixed yet"
+
+    class LegacySync(unittest.SynchronousTestCase):
+        def test_unflushed(self):
+            log.err(KeyError("unflushed sync"))
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "-v", "--twisted-trial", *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 2, "failed": 3})
+    rr.stdout.fnmatch_lines([
+        "*unexpected success, todo: not fixed yet",
+        "*KeyError: 'unflushed'",
+        "*KeyError: 'unflushed sync'",
+    ])
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork()")
+def test_fork_per_module(testdir, cmd_opts):
+    testdir.makepyfile(
+        test_a="""
+        import os
+        from twisted.internet import reactor
+
+        def test_leave_call():
+            reactor.callLater(100, lambda: None)
+            with open("pids", "a") as f:
+                f.write("{}\\n".format(os.getpid()))
+        """,
+        test_b="""
+        import os
+        from twisted.internet import reactor
+
+        def test_fresh_reactor():
+            assert reactor.getDelayedCalls() == []
+            with open("pids", "a") as f:
+                f.write("{}\\n".format(os.getpid()))
+
+        def test_after_fresh_reactor():
+            assert reactor.running
+        """,
+        test_c="""
+        import os
+
+        def test_crash():
+            os._exit(3)
+        """,
+    )
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "-v", "--twisted-fork", *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 3, "failed": 1})
+    rr.stdout.fnmatch_lines(["*forked test process exited with status*"])
+    pids = testdir.tmpdir.join("pids").read().split()
+    assert len(set(pids)) == 2
+
+
+@pytest.mark.skipif(
+    sys.platform == "win32", reason="--reactors is not available on win32",
+)
+def test_reactors_workers(testdir):
+    test_file = """
+    import pytest
+    from twisted.internet import reactor
+
+    def test_any(twisted_reactor_type):
+        is_asyncio = "asyncio" in type(reactor).__module__
+        assert is_asyncio == (twisted_reactor_type == "asyncio")
+
+    @pytest.mark.twisted_reactor("asyncio")
+    def test_only_asyncio(twisted_reactor_type):
+        assert twisted_reactor_type == "asyncio"
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "-v", "--reactors=default,asyncio",
+    )
+    assert_outcomes(rr, {"passed": 3})
+    rr.stdout.fnmatch_lines_random([
+        "*::test_any?default? PASSED*",
+        "*::test_any?asyncio? PASSED*",
+        "*::test_only_asyncio?asyncio? PASSED*",
+    ])
+
+    rr = testdir.run(sys.executable, "-m", "pytest", "-v", "--reactor=default")
+    assert_outcomes(rr, {"passed": 1, "skipped": 1})
+
+
+@pytest.mark.skipif(
+    sys.platform == "win32", reason="--reactors is not available on win32",
+)
+def test_reactors_workers_collect_their_tests_only(testdir):
+    record_import = """
+    import sys
+
+    with open("imports", "a") as f:
+        reactor = [arg for arg in sys.argv if arg.startswith("--reactor=")]
+        f.write("{} {}\\n".format(__name__, "".join(reactor) or "parent"))
+    """
+    testdir.makepyfile(
+        test_any=record_import + """
+    def test_any():
+        pass
+    """,
+        test_asyncio=record_import + """
+    import pytest
+
+    @pytest.mark.twisted_reactor("asyncio")
+    def test_only_asyncio():
+        pass
+    """,
+    )
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "-v", "--reactors=default,asyncio",
+    )
+    assert_outcomes(rr, {"passed": 3})
+    imports = sorted(testdir.tmpdir.join("imports").read().splitlines())
+    assert imports == [
+        "test_any --reactor=asyncio",
+        "test_any --reactor=default",
+        "test_any parent",
+        "test_asyncio --reactor=asyncio",
+        "test_asyncio parent",
+    ]
+
+
+@skip_if_no_async_await()
+def test_trace(testdir, cmd_opts, request):
+    test_file = """
+    from twisted.internet import reactor, defer, task
+    import pytest_twisted
+
+    def tick():
+        pass
+
+    @pytest_twisted.async_fixture()
+    async def foo():
+        await task.deferLater(reactor, 0.01, tick)
+        return 42
+
+    def test_succeed(foo):
+        assert foo == 42
+        return task.deferLater(reactor, 0.01, tick)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "-v",
+        "--twisted-trace=trace.json",
+        *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 1})
+
+    with open(str(testdir.tmpdir.join("trace.json"))) as f:
+        trace = json.load(f)
+    names = {event["name"] for event in trace["traceEvents"]}
+    expected = {
+        "test_trace.py::test_succeed",
+        "fixture foo",
+        "async fixture foo",
+        "blockon",
+        "twisted.internet.defer.Deferred.callback",
+    }
+    if request.config.getoption("twisted_engine", "greenlet") == "greenlet":
+        expected |= {"callLater hop", "twisted greenlet"}
+    assert expected <= names
+
+
+@pytest.mark.parametrize(
+    "opts",
+    [
+        pytest.param(
+            ["--reactors=default,asyncio"],
+            id="reactors",
+            marks=pytest.mark.skipif(
+                sys.platform == "win32",
+                reason="--reactors is not available on win32",
+            ),
+        ),
+        pytest.param(
+            ["--twisted-fork"],
+            id="fork",
+            marks=pytest.mark.skipif(
+                not hasattr(os, "fork"), reason="requires os.fork()",
+            ),
+        ),
+    ],
+)
+def test_trace_merges_workers(testdir, opts):
+    testdir.makepyfile(
+        test_a="""
+        from twisted.internet import reactor, task
+
+        def test_a():
+            return task.deferLater(reactor, 0.01, lambda: None)
+        """,
+        test_b="""
+        def test_b():
+            pass
+        """,
+    )
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "-v", "--twisted-trace=trace.json",
+        *opts
+    )
+    assert rr.ret == 0
+
+    with open(str(testdir.tmpdir.join("trace.json"))) as f:
+        trace = json.load(f)
+    tests = [
+        event
+        for event in trace["traceEvents"]
+        if event.get("cat") == "test"
+    ]
+    # one process per reactor, or per forked module
+    assert len({event["pid"] for event in tests}) == 2
+    assert len(tests) == (4 if "--reactors" in opts[0] else 2)
+    assert testdir.tmpdir.listdir("trace.json.*") == []
+
+
+@skip_if_no_async_await()
+@parametrize_processes()
+def test_twisted_benchmark(testdir, cmd_opts, opts):
+    test_file = """
+    from twisted.internet import reactor, task
+    import pytest_twisted
+
+    async def ping():
+        return await task.deferLater(reactor, 0, lambda: "pong")
+
+    def test_auto(twisted_benchmark):
+        d = twisted_benchmark(ping)
+        d.addCallback(lambda result: result == "pong" or 1 / 0)
+        return d
+
+    @pytest_twisted.ensureDeferred
+    async def test_pedantic(twisted_benchmark):
+        result = await twisted_benchmark.pedantic(
+            task.deferLater,
+            args=(reactor, 0.01, lambda: 42),
+            rounds=3,
+            iterations=2,
+        )
+        assert result == 42
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "-v",
+        "--twisted-benchmark-json=bench.json",
+        "--twisted-benchmark-max-time=0.05",
+        *(list(opts) + list(cmd_opts))
+    )
+    assert_outcomes(rr, {"passed": 2})
+    rr.stdout.fnmatch_lines(["*twisted benchmarks*"])
+
+    with open(str(testdir.tmpdir.join("bench.json"))) as f:
+        # --reactors adds the reactor to the test ids
+        benchmarks = {
+            benchmark["name"].split("[")[0]: benchmark
+            for benchmark in json.load(f)["benchmarks"]
+        }
+
+    auto = benchmarks["test_auto"]["stats"]
+    assert auto["rounds"] >= 5
+    assert auto["min"] <= auto["median"] <= auto["max"]
+
+    pedantic = benchmarks["test_pedantic"]["stats"]
+    assert (pedantic["rounds"], pedantic["iterations"]) == (3, 2)
+    assert pedantic["min"] >= 0.01
+    assert "cpu" in benchmarks["test_pedantic"]["extra_info"]
+
+
+@skip_if_no_async_await()
+@parametrize_processes()
+def test_twisted_load(testdir, cmd_opts, opts):
+    test_file = """
+    import itertools
+    import time
+
+    from twisted.internet import reactor, task
+    import pytest_twisted
+
+    @pytest_twisted.ensureDeferred
+    async def test_concurrency(twisted_load):
+        stats = await twisted_load(
+            lambda: task.deferLater(reactor, 0, lambda: None),
+            concurrency=10,
+            iterations=200,
+        )
+        assert (stats.count, stats.errors) == (200, 0)
+        assert stats.min <= stats.p50 <= stats.p99 <= stats.p999 <= stats.max
+        assert stats.throughput > 0
+
+    @pytest_twisted.ensureDeferred
+    async def test_errors(twisted_load):
+        counter = itertools.count()
+
+        async def flaky():
+            if next(counter) % 2:
+                raise ValueError("boom")
+
+        stats = await twisted_load(flaky, iterations=20)
+        assert (stats.count, stats.errors) == (10, 10)
+        assert stats.failures[0] == "boom"
+
+    @pytest_twisted.ensureDeferred
+    async def test_rate(twisted_load):
+        stats = await twisted_load(lambda: None, rate=100, duration=0.2)
+        assert 10 <= stats.count <= 21
+
+    @pytest_twisted.ensureDeferred
+    async def test_rate_backlog(twisted_load):
+        # a stalled reactor leaves thousands of calls due at once, well
+        # before the deadline even on a busy machine
+        reactor.callLater(0.05, time.sleep, 0.2)
+        stats = await twisted_load(lambda: None, rate=20000, duration=1.0)
+        assert stats.errors == 0
+        assert stats.count > 2000
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "-v", *(list(opts) + list(cmd_opts))
+    )
+    assert_outcomes(rr, {"passed": 4})
+    rr.stdout.fnmatch_lines(
+        ["*twisted load*", "*test_concurrency*: 200 calls, 0 errors*"],
+    )
+
+
+def test_longest_first(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import reactor, task
+
+    def test_fast():
+        pass
+
+    def test_slow():
+        return task.deferLater(reactor, 0.2, lambda: None)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(sys.executable, "-m", "pytest", "-v", *cmd_opts)
+    assert_outcomes(rr, {"passed": 2})
+
+    durations_path = testdir.tmpdir.join(
+        ".pytest_cache", "v", "pytest_twisted", "durations",
+    )
+    with open(str(durations_path)) as f:
+        durations = json.load(f)
+    slow = durations["test_longest_first.py::test_slow"]
+    assert slow["reactor"] >= 0.2
+    assert slow["wall"] >= slow["reactor"]
+
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "-v",
+        "--twisted-longest-first",
+        "--twisted-weights=weights.json",
+        *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 2})
+    rr.stdout.fnmatch_lines(["*::test_slow PASSED*", "*::test_fast PASSED*"])
+
+    with open(str(testdir.tmpdir.join("weights.json"))) as f:
+        weights = json.load(f)
+    assert [weight["nodeid"].split("::")[1] for weight in weights] == [
+        "test_slow",
+        "test_fast",
+    ]
+    assert weights[0]["weight"] >= 0.2
+
+
+def test_durations_not_saved_by_xdist_workers(testdir, cmd_opts):
+    testdir.makeconftest("""
+    import pytest
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_configure(config):
+        # what pytest-xdist sets in its workers
+        config.workerinput = {"workerid": "gw0"}
+    """)
+    testdir.makepyfile("""
+    def test_pass():
+        pass
+    """)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "-v",
+        "--twisted-longest-first",
+        "--twisted-weights=weights.json",
+        *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 1})
+    assert not testdir.tmpdir.join(
+        ".pytest_cache", "v", "pytest_twisted", "durations",
+    ).check()
+    assert not testdir.tmpdir.join("weights.json").check()
+
+
+def test_cache_clear_skipped_by_xdist_workers(testdir, cmd_opts):
+    testdir.makeconftest("""
+    import pytest
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_configure(config):
+        # what pytest-xdist sets in its workers
+        config.workerinput = {"workerid": "gw0"}
+    """)
+    testdir.makepyfile("""
+    def test_pass():
+        pass
+    """)
+    entry = testdir.tmpdir.join(
+        ".pytest_cache", "d", "pytest_twisted_fixtures", "entry.pickle",
+    )
+    entry.write("kept", ensure=True)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "-v", "--twisted-cache-clear",
+        *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 1})
+    assert entry.check()
+
+
+@skip_if_no_async_await()
+def test_async_fixture_cache(testdir, cmd_opts):
+    test_file = """
+    import pytest_twisted
+
+    def count_call(name):
+        with open(name, "a") as f:
+            f.write("x")
+
+    @pytest_twisted.async_fixture(cache="v1")
+    async def data():
+        count_call("data.calls")
+        return {"answer": 42}
+
+    @pytest_twisted.async_fixture(cache=True, cache_mmap=True)
+    async def blob():
+        count_call("blob.calls")
+        return b"abc" * 1000
+
+    @pytest_twisted.async_fixture(cache=False)
+    async def uncached():
+        count_call("uncached.calls")
+        return 7
+
+    def test_cached(data, blob, uncached):
+        assert data == {"answer": 42}
+        assert (blob[:3], len(blob)) == (b"abc", 3000)
+        assert uncached == 7
+    """
+    testdir.makepyfile(test_file)
+
+    def calls():
+        return [
+            testdir.tmpdir.join(name).read()
+            for name in ("data.calls", "blob.calls", "uncached.calls")
+        ]
+
+    for expected, uncached, extra_opts in (
+            ("x", "x", ()),
+            ("x", "xx", ()),
+            ("xx", "xxx", ("--twisted-cache-clear",)),
+    ):
+        rr = testdir.run(
+            sys.executable, "-m", "pytest", "-v", *(cmd_opts + extra_opts)
+        )
+        assert_outcomes(rr, {"passed": 1})
+        assert calls() == [expected, expected, uncached]
+
+
+@skip_if_no_async_await()
+def test_parametrize_async(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import defer, reactor
+    import pytest_twisted
+
+    calls = []
+    opened = defer.Deferred()
+
+    async def numbers():
+        # only fires if letters() is resolved at the same time
+        calls.append("numbers")
+        await opened.addTimeout(1, reactor)
+        return [1, 2]
+
+    def letters():
+        calls.append("letters")
+        opened.callback(None)
+        return defer.succeed(["a", "b", "c"])
+
+    async def letter_ids():
+        return ["x", "y", "z"]
+
+    @pytest_twisted.parametrize_async("number", numbers)
+    def test_numbers(number):
+        assert number in (1, 2)
+
+    @pytest_twisted.parametrize_async("letter", letters, ids=letter_ids())
+    def test_letters(letter):
+        assert letter in "abc"
+
+    @pytest_twisted.parametrize_async("number", numbers)
+    def test_memoized(number):
+        assert calls == ["numbers", "letters"]
+
+    @pytest_twisted.parametrize_async(
+        "number", numbers, ids=lambda number: "id%d" % number,
+    )
+    def test_callable_ids(number):
+        assert number in (1, 2)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(sys.executable, "-m", "pytest", "-v", *cmd_opts)
+    assert_outcomes(rr, {"passed": 9})
+    rr.stdout.fnmatch_lines([
+        "*::test_letters[[]z[]] PASSED*",
+        "*::test_callable_ids[[]id2[]] PASSED*",
+    ])
+
+
+@skip_if_no_async_await()
+def test_hypothesis(testdir, cmd_opts):
+    pytest.importorskip("hypothesis")
+    test_file = """
+    from hypothesis import given, settings, strategies
+    from twisted.internet import reactor, task
+    import pytest_twisted
+
+    examples = []
+
+    @settings(max_examples=200)
+    @given(strategies.integers())
+    @pytest_twisted.ensureDeferred
+    async def test_passes(n):
+        examples.append(n)
+        assert await task.deferLater(reactor, 0, lambda: n) == n
+
+    def test_all_examples_ran():
+        assert len(examples) == 200
+
+    @given(strategies.integers(min_value=0))
+    @pytest_twisted.inlineCallbacks
+    def test_shrinks(n):
+        result = yield task.deferLater(reactor, 0, lambda: n)
+        assert result < 10
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(sys.executable, "-m", "pytest", "-v", *cmd_opts)
+    assert_outcomes(rr, {"passed": 2, "failed": 1})
+    rr.stdout.fnmatch_lines(["*test_shrinks(*", "*n=10,*"])
+
+
+def test_greenlet_per_test(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import defer, reactor, task
+    import pytest_twisted
+
+    def test_blockon():
+        assert pytest_twisted.blockon(task.deferLater(reactor, 0, int)) == 0
+
+    def test_blockon_in_callback():
+        def nested():
+            return pytest_twisted.blockon(
+                task.deferLater(reactor, 0, lambda: 7),
+            ) * 6
+
+        d = task.deferLater(reactor, 0, nested)
+        assert pytest_twisted.blockon(d) == 42
+
+    def test_handler():
+        received = defer.Deferred()
+
+        @pytest_twisted.in_greenlet
+        def handler(data):
+            d = task.deferLater(reactor, 0, lambda: data * 2)
+            return pytest_twisted.blockon(d)
+
+        received.addCallback(handler)
+        reactor.callFromThread(received.callback, 21)
+        assert pytest_twisted.blockon(received) == 42
+
+    def test_fired_by_delayed_call():
+        done = []
+        d = task.deferLater(reactor, 0.01, lambda: None)
+        d.addCallback(done.append)
+        d.addCallback(lambda _: done.append("rest of the chain"))
+        pytest_twisted.blockon(d)
+        assert done == [None, "rest of the chain"]
+        return task.deferLater(reactor, 0.01, lambda: None)
+
+    def test_returns_deferred_fired_by_delayed_call():
+        return task.deferLater(reactor, 0.01, lambda: None)
+
+    def test_no_greenlet_left_suspended():
+        import gc
+        import greenlet
+
+        suspended = [
+            g
+            for g in gc.get_objects()
+            if isinstance(g, pytest_twisted._ReactorGreenlet)
+            and g
+            and g is not greenlet.getcurrent()
+        ]
+        assert suspended == []
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "-v",
+        "--twisted-greenlet-per-test", *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 6})
+    output = rr.stdout.str() + rr.stderr.str()
+    assert "Unhandled error" not in output
+    assert "GreenletExit" not in output
+
+
+def test_io_stats(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import defer, endpoints, protocol, reactor
+    from twisted.protocols import basic
+    import pytest_twisted
+
+    class Echo(basic.LineReceiver):
+        def lineReceived(self, line):
+            self.sendLine(line)
+
+    class Client(basic.LineReceiver):
+        def connectionMade(self):
+            self.sendLine(b"x" * 99)
+
+        def lineReceived(self, line):
+            self.factory.received.callback(line)
+
+    @pytest_twisted.inlineCallbacks
+    def test_echo():
+        server = endpoints.TCP4ServerEndpoint(
+            reactor, 0, interface="127.0.0.1",
+        )
+        port = yield server.listen(protocol.Factory.forProtocol(Echo))
+        factory = protocol.ClientFactory.forProtocol(Client)
+        factory.received = defer.Deferred()
+        client = endpoints.TCP4ClientEndpoint(
+            reactor, "127.0.0.1", port.getHost().port,
+        )
+        proto = yield client.connect(factory)
+        assert (yield factory.received) == b"x" * 99
+        proto.transport.loseConnection()
+        yield port.stopListening()
+
+    def test_quiet():
+        pass
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "-v",
+        "--twisted-io-stats", "--junitxml=junit.xml", *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 2})
+    rr.stdout.fnmatch_lines([
+        "*twisted socket I/O*",
+        "total: 2 connections, 202 bytes read, 202 bytes written, *",
+        "*::test_echo: 2 connections, *",
+    ])
+    junit = testdir.tmpdir.join("junit.xml").read()
+    written = re.findall(
+        r'name="twisted_io_bytes_written" value="(\d+)"', junit,
+    )
+    assert written == ["202", "0"]
+
+
+def test_greenlet_per_test_outcome_after_wait(testdir, cmd_opts):
+    pytest.importorskip("hypothesis")
+    test_file = """
+    import pytest
+    from hypothesis import Phase, given, settings, strategies
+    from twisted.internet import reactor, task
+    import pytest_twisted
+
+    def wait():
+        return pytest_twisted.blockon(task.deferLater(reactor, 0.01, int))
+
+    def test_skip():
+        wait()
+        pytest.skip("skipped after a wait")
+
+    def test_fail():
+        wait()
+        pytest.fail("failed after a wait")
+
+    @settings(phases=[Phase.generate], database=None)
+    @given(strategies.integers())
+    @pytest_twisted.inlineCallbacks
+    def test_property_skip(n):
+        yield task.deferLater(reactor, 0.01, int)
+        pytest.skip("skipped after a wait")
+
+    @settings(phases=[Phase.generate], database=None)
+    @given(strategies.integers())
+    @pytest_twisted.inlineCallbacks
+    def test_property_fail(n):
+        yield task.deferLater(reactor, 0.01, int)
+        pytest.fail("failed after a wait")
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "-v",
+        "--twisted-greenlet-per-test", *cmd_opts,
+        timeout=60
+    )
+    assert_outcomes(rr, {"skipped": 2, "failed": 2})
+
+
+def test_twisted_process_pool(testdir, cmd_opts):
+    test_file = """
+    import os
+
+    import pytest
+    from twisted.internet import defer
+    import pytest_twisted
+
+    def square(x):
+        return x * x
+
+    def fail():
+        raise ValueError("boom")
+
+    def blob(size):
+        return b"x" * size
+
+    @pytest_twisted.inlineCallbacks
+    def test_pool(twisted_process_pool):
+        pool = twisted_process_pool
+        squares = yield defer.gatherResults(
+            [pool.submit(square, i) for i in range(10)],
+        )
+        assert squares == [i * i for i in range(10)]
+
+        pid = yield pool.submit(os.getpid)
+        assert pid != os.getpid()
+
+        size = 4 << 20
+        assert (yield pool.submit(blob, size)) == b"x" * size
+        assert (yield pool.submit(len, b"y" * size)) == size
+
+        with pytest.raises(ValueError) as excinfo:
+            yield pool.submit(fail)
+        assert "in fail" in excinfo.value.remote_traceback
+
+    def test_same_pool(twisted_process_pool):
+        return twisted_process_pool.submit(square, 3).addCallback(
+            lambda result: result == 9 or 1 / 0,
+        )
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "-v",
+        "--twisted-process-pool-size=2",
+        *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 2})
+
+
+@pytest.mark.parametrize(
+    "factory, use_ini",
+    (
+        ("instrumented:new_event_loop", False),
+        ("instrumented:Policy", False),
+        ("instrumented.new_event_loop", True),
+    ),
+)
+def test_asyncio_loop_factory(testdir, cmd_opts, request, factory, use_ini):
+    skip_if_reactor_not(request, "asyncio")
+    testdir.makepyfile(instrumented="""
+    import asyncio
+
+    class InstrumentedLoop(asyncio.SelectorEventLoop):
+        pass
+
+    def new_event_loop():
+        return InstrumentedLoop()
+
+    class Policy(asyncio.DefaultEventLoopPolicy):
+        def new_event_loop(self):
+            return InstrumentedLoop()
+    """)
+    test_file = """
+    import asyncio
+
+    from twisted.internet import reactor
+    import pytest_twisted
+
+    @pytest_twisted.ensureDeferred
+    async def test_loop():
+        loop = reactor._asyncioEventloop
+        assert type(loop).__name__ == "InstrumentedLoop"
+        assert asyncio.get_event_loop() is loop
+    """
+    testdir.makepyfile(test_file)
+    if use_ini:
+        testdir.makeini(
+            "[pytest]\ntwisted_asyncio_loop = {}\n".format(factory),
+        )
+        factory_opts = ()
+    else:
+        factory_opts = ("--twisted-asyncio-loop={}".format(factory),)
+
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "-v", *(cmd_opts + factory_opts)
+    )
+    assert_outcomes(rr, {"passed": 1})
+
+
+def test_wrong_asyncio_loop(testdir, cmd_opts, request):
+    skip_if_reactor_not(request, "asyncio")
+    testdir.makepyfile(instrumented="""
+    import asyncio
+
+    class InstrumentedLoop(asyncio.SelectorEventLoop):
+        pass
+    """)
+    conftest_file = """
+    def pytest_addhooks():
+        from twisted.internet import asyncioreactor
+        asyncioreactor.install()
+    """
+    testdir.makeconftest(conftest_file)
+    test_file = """
+    def test_succeed():
+        pass
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "-v",
+        "--twisted-asyncio-loop=instrumented:InstrumentedLoop",
+        *cmd_opts
+    )
+    assert "WrongReactorAlreadyInstalledError" in rr.stderr.str()
+    assert "InstrumentedLoop" in rr.stderr.str()
+
+
+@pytest.mark.skipif(
+    sys.platform == "win32",
+    reason="os.kill() with SIGINT terminates the process on win32",
+)
+def test_ctrl_c_cancels_waiting_test(testdir, cmd_opts):
+    test_file = """
+    import os
+    import signal
+
+    from twisted.internet import reactor, defer
+
+    def test_hang():
+        def cancelled(d):
+            with open("cancelled", "w"):
+                pass
+
+        reactor.callLater(0.2, os.kill, os.getpid(), signal.SIGINT)
+        reactor.callLater(60, lambda: None)
+        return defer.Deferred(cancelled)
+
+    def test_after():
+        pass
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "-v",
+        *cmd_opts,
+        timeout=20
+    )
+    assert rr.ret == 2
+    rr.stdout.fnmatch_lines(["*KeyboardInterrupt*"])
+    assert "test_after" not in rr.stdout.str()
+    assert testdir.tmpdir.join("cancelled").check()
+
+
+@pytest.mark.skipif(
+    sys.platform == "win32",
+    reason="os.kill() with SIGINT terminates the process on win32",
+)
+def test_ctrl_c_during_shutdown(testdir, cmd_opts):
+    test_file = """
+    import os
+    import signal
+    import threading
+    import time
+
+    import pytest
+    from twisted.internet import reactor, defer
+
+    def interrupt():
+        for _ in range(3):
+            time.sleep(0.2)
+            os.kill(os.getpid(), signal.SIGINT)
+
+    def hang():
+        threading.Thread(target=interrupt).start()
+        return defer.Deferred()
+
+    @pytest.fixture(scope="session", autouse=True)
+    def stuck_shutdown():
+        reactor.addSystemEventTrigger("before", "shutdown", hang)
+
+    def test_pass():
+        pass
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "-v",
+        "--twisted-abort-timeout=30",
+        *cmd_opts,
+        timeout=20
+    )
+    rr.stdout.fnmatch_lines([
+        "shutdown interrupted, reactor stopped forcibly",
+        "stuck shutdown trigger: *hang",
+    ])
+
+
+def test_exitfirst_bounds_shutdown(testdir, cmd_opts):
+    test_file = """
+    import pytest
+    from twisted.internet import reactor, defer
+
+    def hang():
+        return defer.Deferred()
+
+    @pytest.fixture(scope="session", autouse=True)
+    def stuck_shutdown():
+        reactor.addSystemEventTrigger("before", "shutdown", hang)
+
+    def test_fail():
+        assert False
+
+    def test_not_run():
+        pass
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "-v",
+        "-x",
+        "--twisted-abort-timeout=0.5",
+        *cmd_opts,
+        timeout=20
+    )
+    assert_outcomes(rr, {"failed": 1})
+    rr.stdout.fnmatch_lines([
+        "shutdown deadline of 0.5s exceeded, reactor stopped forcibly",
+        "stuck shutdown trigger: *hang",
+    ])